@@ -0,0 +1,82 @@
+"""
+Measure how long rendering a QR code image takes and how much memory it allocates.
+
+"blocks" are the Python memory blocks which were allocated for the result,
+"peak" is the most Python memory which was allocated while it was rendered;
+the pixels, which Pillow allocates itself, are not included.
+
+usage: python scripts/bench_qr.py [number of images]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import qrcode
+
+from mailadm.conn import Config, TokenInfo
+from mailadm.gen_qr import QRRenderer
+
+
+def make_token(config, i):
+    name = "bench%d" % (i,)
+    return TokenInfo(config, name, "1w_%016d" % (i,), "1w", "tmp.", 50, 0)
+
+
+def encode(token_info):
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, border=1)
+    qr.add_data(token_info.get_qr_uri())
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def measure(label, func, tokens):
+    func(tokens[0])  # warm up
+    start = time.perf_counter()
+    for token_info in tokens:
+        func(token_info)
+    duration = (time.perf_counter() - start) / len(tokens)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func(tokens[0])  # noqa: F841 the result is kept for the snapshot
+    after = tracemalloc.take_snapshot()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    print(
+        "{:<12} {:8.2f} ms/image  {:6d} blocks  {:8.1f} KiB peak".format(
+            label,
+            duration * 1000,
+            blocks,
+            peak / 1024,
+        ),
+    )
+
+
+def main(count=50):
+    config = Config(
+        mail_domain="example.org",
+        web_endpoint="https://example.org/new_email",
+        dbversion=None,
+        mailcow_endpoint="https://example.org/api/v1/",
+        mailcow_token="",
+    )
+    tokens = [make_token(config, i) for i in range(count)]
+
+    start = time.perf_counter()
+    renderer = QRRenderer()
+    print("loading assets: {:.2f} ms".format((time.perf_counter() - start) * 1000))
+    # encoding the data takes most of the time, it is done by the qrcode package
+    measure("qr matrix", encode, tokens)
+    measure("render", lambda token_info: renderer.render(config, token_info), tokens)
+    measure(
+        "render+png",
+        lambda token_info: renderer.render(config, token_info).save("/dev/null", format="PNG"),
+        tokens,
+    )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -4,14 +4,39 @@ import os
 import sqlite3
 import sys
 import time
-from threading import Event
+from threading import Event, Timer
 
 import deltachat
 from deltachat import account_hookimpl
+from deltachat.capi import ffi
 from deltachat.capi import lib as dclib
 
-from mailadm.commands import add_token, add_user, list_tokens, prune, qr_from_token
+from mailadm.commands import (
+    add_token,
+    add_user,
+    list_tokens,
+    qr_png_from_token,
+    refresh_mailboxes,
+    top_queries,
+)
 from mailadm.db import DB, get_db_path
+from mailadm.scheduler import PruneScheduler
+from mailadm.workers import WorkerPool
+
+# how often the mirror of the mailcow mailboxes is refreshed
+MAILBOX_REFRESH_INTERVAL = 10 * 60
+# how often the members of the admin group are reloaded, in case a hook was missed
+ADMINS_REFRESH_INTERVAL = 60 * 60
+# after how many seconds the bot tells an admin that it is still working on a command
+COMMAND_ACK_DELAY = 3
+# how many users /list-users shows per message
+LIST_USERS_PAGE = 100
+# the name of a support group is the address of the support user plus this
+SUPPORT_GROUP_SUFFIX = " support group"
+# the roles of group chats
+ADMIN_GROUP = "admin"
+SUPPORT_GROUP = "support"
+FOREIGN_GROUP = "foreign"
 
 
 class SetupPlugin:
@@ -32,14 +57,41 @@ class SetupPlugin:
 
 
 class AdmBot:
-    def __init__(self, db: DB, account: deltachat.Account):
+    def __init__(self, db: DB, account: deltachat.Account, prune_scheduler=None, workers=None):
         self.db = db
         self.account = account
+        self.prune_scheduler = prune_scheduler
+        self.workers = WorkerPool() if workers is None else workers
         with self.db.read_connection() as conn:
             config = conn.config
             self.admingrpid = int(config.admingrpid)
             self.admingroup = account.get_chat_by_id(self.admingrpid)
             self.mail_domain = config.mail_domain
+            self.chat_roles = conn.get_chat_roles()
+        self.refresh_admins()
+        self.rebuild_support_groups()
+
+    def refresh_admins(self):
+        """reload the members of the admin group, including the bot itself.
+
+        The hooks below keep them up to date; the dict is replaced instead of
+        changed, because the main loop refreshes it from another thread.
+        """
+        self.admins = {contact.id: contact for contact in self.admingroup.get_contacts()}
+
+    @account_hookimpl
+    def ac_member_added(self, chat: deltachat.Chat, contact, actor, message):
+        if chat.id == self.admingrpid:
+            admins = dict(self.admins)
+            admins[contact.id] = contact
+            self.admins = admins
+
+    @account_hookimpl
+    def ac_member_removed(self, chat: deltachat.Chat, contact, actor, message):
+        if chat.id == self.admingrpid:
+            admins = dict(self.admins)
+            admins.pop(contact.id, None)
+            self.admins = admins
 
     @account_hookimpl
     def ac_incoming_message(self, message: deltachat.Message):
@@ -48,7 +100,7 @@ class AdmBot:
         if self.is_admin_group_message(message):
             if message.text.startswith("/"):
                 logging.info("%s seems to be a command.", message.text)
-                self.handle_command(message)
+                self.submit_command(message)
             else:
                 logging.debug("ignoring message, it's just admins discussing in the admin group")
         elif self.is_support_group(message.chat):
@@ -80,28 +132,95 @@ class AdmBot:
 
     def is_support_group(self, chat: deltachat.Chat) -> bool:
         """Checks whether the group was created by the bot."""
-        return (
-            chat.is_group()
-            and chat.get_messages()[0].get_sender_contact() == self.account.get_self_contact()
-        )
+        return self.get_chat_role(chat) == SUPPORT_GROUP
+
+    def get_chat_role(self, chat: deltachat.Chat):
+        """Return whether a group is the admin group, a support group, or a foreign group.
+
+        A group is only classified the first time the bot sees it, because
+        that loads all of its messages; the role is stored in the mailadm DB.
+        Returns None for 1:1 chats.
+        """
+        if chat.id == self.admingrpid:
+            return ADMIN_GROUP
+        role = self.chat_roles.get(chat.id)
+        if role is None:
+            if not chat.is_group():
+                return None
+            messages = chat.get_messages()
+            if messages and messages[0].get_sender_contact() == self.account.get_self_contact():
+                role = SUPPORT_GROUP
+            else:
+                role = FOREIGN_GROUP
+            self.set_chat_role(chat.id, role)
+        return role
+
+    def set_chat_role(self, chat_id: int, role: str):
+        with self.db.write_transaction() as conn:
+            conn.set_chat_role(chat_id, role)
+        self.chat_roles[chat_id] = role
+
+    def rebuild_support_groups(self):
+        """remember which chat is the support group of which user in the mailadm DB.
+
+        Known support groups are kept, even if they were renamed, as long as
+        the chat exists; support groups which aren't known yet are found by
+        their name.
+        """
+        chats = {chat.id: chat for chat in self.account.get_chats()}
+        with self.db.read_connection() as conn:
+            known = conn.get_support_groups()
+        groups = {addr: chat_id for addr, chat_id in known.items() if chat_id in chats}
+        chat_ids = set(groups.values())
+        for chat in chats.values():
+            name = chat.get_name()
+            if not name.endswith(SUPPORT_GROUP_SUFFIX) or chat.id in chat_ids:
+                continue
+            addr = name[: -len(SUPPORT_GROUP_SUFFIX)]
+            if addr not in groups and self.is_support_group(chat):
+                groups[addr] = chat.id
+                chat_ids.add(chat.id)
+        with self.db.write_transaction() as conn:
+            conn.set_support_groups(groups)
+            for chat_id in chat_ids:
+                conn.set_chat_role(chat_id, SUPPORT_GROUP)
+        self.chat_roles.update(dict.fromkeys(chat_ids, SUPPORT_GROUP))
+        logging.info("found %d support groups", len(groups))
 
     def forward_to_support_group(self, message: deltachat.Message):
         """forward a support request to a support group; create one if it doesn't exist yet."""
         support_user = message.get_sender_contact().addr
-        admins = self.admingroup.get_contacts()
-        admins.remove(self.account.get_self_contact())
-        group_name = support_user + " support group"
-        for chat in self.account.get_chats():
-            if chat.get_name() == group_name:
-                support_group = chat
-                break
+        with self.db.read_connection() as conn:
+            chat_id = conn.get_support_group_id(support_user)
+        if chat_id is not None and not self.chat_exists(chat_id):
+            logging.info("the support group of %s was deleted", support_user)
+            with self.db.write_transaction() as conn:
+                conn.del_support_group(support_user)
+            chat_id = None
+        if chat_id is not None:
+            support_group = self.account.get_chat_by_id(chat_id)
         else:
+            self_id = self.account.get_self_contact().id
+            admins = [contact for contact in self.admins.values() if contact.id != self_id]
+            group_name = support_user + SUPPORT_GROUP_SUFFIX
             logging.info("creating new support group: '%s'", group_name)
             support_group = self.account.create_group_chat(group_name, admins)
             support_group.set_profile_image("assets/avatar.jpg")
+            with self.db.write_transaction() as conn:
+                conn.set_support_group_id(support_user, support_group.id)
+                conn.set_chat_role(support_group.id, SUPPORT_GROUP)
+            self.chat_roles[support_group.id] = SUPPORT_GROUP
         message.set_override_sender_name(support_user)
         support_group.send_msg(message)
 
+    def chat_exists(self, chat_id: int) -> bool:
+        """Checks whether a chat still exists, e.g. hasn't been deleted by an admin."""
+        dc_chat = dclib.dc_get_chat(self.account._dc_context, chat_id)
+        if dc_chat == ffi.NULL:
+            return False
+        dclib.dc_chat_unref(dc_chat)
+        return True
+
     def forward_reply_to_support_user(self, message: deltachat.Message):
         """an admin replied in a support group; forward their reply to the user."""
         recipient = message.quote.override_sender_name
@@ -111,13 +230,9 @@ class AdmBot:
 
     def is_admin_group_message(self, command: deltachat.Message):
         """Checks whether the incoming message was in the admin group."""
-        if command.chat.is_group() and self.admingrpid == command.chat.id:
-            if (
-                command.chat.is_protected()
-                and command.is_encrypted()
-                and int(command.chat.num_contacts()) >= 2
-            ):
-                if command.get_sender_contact() in command.chat.get_contacts():
+        if self.admingrpid == command.chat.id:
+            if self.admingroup.is_protected() and command.is_encrypted() and len(self.admins) >= 2:
+                if command.get_sender_contact().id in self.admins:
                     return True
                 else:
                     logging.info(
@@ -133,19 +248,47 @@ class AdmBot:
         else:
             return False
 
-    def handle_command(self, message: deltachat.Message):
+    def submit_command(self, message: deltachat.Message):
+        """execute the command on a worker thread, so slow commands don't block other messages.
+
+        The commands of one admin are executed in the order they were sent.
+        """
+        accepted = self.workers.submit(
+            message.get_sender_contact().id,
+            lambda: self.run_command(message),
+            on_timeout=lambda: self.reply(message, "Sorry, I was too busy, please try again."),
+        )
+        if not accepted:
+            logging.warning("too many commands are waiting, refusing %s", message.text)
+            self.reply(message, "Sorry, I am too busy right now, please try again later.")
+
+    def run_command(self, message: deltachat.Message):
+        """execute the command; tell the admin if it takes a while."""
+        ack = Timer(COMMAND_ACK_DELAY, self.reply, (message, "working on it..."))
+        ack.start()
+        try:
+            self.handle_command(message, ack=ack)
+        except Exception as e:
+            logging.exception("command failed: %s", message.text)
+            self.reply(message, "ERROR: %s failed: %s" % (message.text.split(" ")[0], e))
+        finally:
+            ack.cancel()
+
+    def handle_command(self, message: deltachat.Message, ack=None):
         """execute the command and reply to the admin."""
         arguments = message.text.split(" ")
         image_path = None
 
         if arguments[0] == "/add-token":
             text, image_path = self.add_token(arguments)
+            self.trigger_prune()
 
         elif arguments[0] == "/gen-qr":
             text, image_path = self.gen_qr(arguments)
 
         elif arguments[0] == "/add-user":
             text = self.add_user(arguments)
+            self.trigger_prune()
 
         elif arguments[0] == "/list-users":
             text = self.list_users(arguments)
@@ -153,15 +296,25 @@ class AdmBot:
         elif arguments[0] == "/list-tokens":
             text = list_tokens(self.db)
 
+        elif arguments[0] == "/top-queries":
+            text = top_queries(self.db)
+
         else:
             text = (
                 "/add-user addr password token\n"
                 "/add-token name expiry maxuse (prefix)\n"
                 "/gen-qr token\n"
-                "/list-users (token)\n"
-                "/list-tokens"
+                "/list-users (token) (after-address)\n"
+                "/list-tokens\n"
+                "/top-queries"
             )
 
+        if ack is not None:
+            ack.cancel()
+        self.reply(message, text, image_path)
+
+    def reply(self, message: deltachat.Message, text: str, image_path=None):
+        """send a reply to a command to the admin group."""
         if image_path:
             msg = deltachat.Message.new_empty(self.account, "image")
             mime_type = mimetypes.guess_type(image_path)[0]
@@ -173,6 +326,11 @@ class AdmBot:
         sent_id = dclib.dc_send_msg(self.account._dc_context, self.admingroup.id, msg._dc_msg)
         assert sent_id == msg.id
 
+    def trigger_prune(self):
+        """tell the prune scheduler that accounts may expire earlier now."""
+        if self.prune_scheduler is not None:
+            self.prune_scheduler.trigger()
+
     def add_token(self, arguments: [str]):
         """add a token via bot command"""
         if len(arguments) == 4:
@@ -197,7 +355,7 @@ class AdmBot:
         if result["status"] == "error":
             return "ERROR: " + result.get("message"), None
         text = result.get("message")
-        fn = qr_from_token(self.db, arguments[1])["filename"]
+        fn = qr_png_from_token(self.db, arguments[1])["filename"]
         return text, fn
 
     def gen_qr(self, arguments: [str]):
@@ -205,7 +363,8 @@ class AdmBot:
         if len(arguments) != 2:
             return "Sorry, which token do you want a QR code for?", None
         else:
-            return "", qr_from_token(self.db, tokenname=arguments[1]).get("filename")
+            result = qr_png_from_token(self.db, tokenname=arguments[1])
+            return result.get("message", ""), result.get("filename")
 
     def add_user(self, arguments: [str]):
         """add a user via bot command"""
@@ -231,11 +390,23 @@ class AdmBot:
             return result.get("message")
 
     def list_users(self, arguments: [str]):
-        """list users per bot command"""
-        token = arguments[1] if len(arguments) > 1 else None
+        """list users per bot command, one page per message.
+
+        An argument with an @ is the address after which the page starts.
+        """
+        after = ""
+        token = None
+        for argument in arguments[1:]:
+            if "@" in argument:
+                after = argument
+            else:
+                token = argument
         with self.db.read_connection() as conn:
-            users = conn.get_user_list(token=token)
-        lines = ["%s [%s]" % (user.addr, user.token_name) for user in users]
+            users = list(conn.iter_user_list(token=token, after=after, limit=LIST_USERS_PAGE + 1))
+        lines = ["%s [%s]" % (user.addr, user.token_name) for user in users[:LIST_USERS_PAGE]]
+        if len(users) > LIST_USERS_PAGE:
+            command = ["/list-users", token, users[LIST_USERS_PAGE - 1].addr]
+            lines.append("\nmore users: " + " ".join(arg for arg in command if arg))
         return "\n".join(lines)
 
 
@@ -262,18 +433,29 @@ def main(mailadm_db, admbot_db_path):
                 os._exit(1)
             displayname = conn.config.mail_domain + " administration"
         ac.set_avatar("assets/avatar.jpg")
-        ac.run_account(account_plugins=[AdmBot(mailadm_db, ac)], show_ffi=True)
+        scheduler = PruneScheduler(mailadm_db)
+        admbot = AdmBot(mailadm_db, ac, scheduler)
+        ac.run_account(account_plugins=[admbot], show_ffi=True)
         ac.set_config("mvbox_move", "1")
         ac.set_config("show_emails", "2")
         ac.set_config("displayname", displayname)
+        next_refresh = 0
+        next_admins_refresh = time.time() + ADMINS_REFRESH_INTERVAL
         while 1:
-            for logmsg in prune(mailadm_db).get("message"):
-                logging.info("%s", logmsg)
-            for _second in range(600):
-                if not ac._event_thread.is_alive():
-                    logging.error("dc core event thread died, exiting now")
-                    os._exit(1)
-                time.sleep(1)
+            if time.time() >= next_refresh:
+                result = refresh_mailboxes(mailadm_db)
+                if result["status"] == "error":
+                    logging.warning("%s", result["message"])
+                next_refresh = time.time() + MAILBOX_REFRESH_INTERVAL
+            if time.time() >= next_admins_refresh:
+                admbot.refresh_admins()
+                next_admins_refresh = time.time() + ADMINS_REFRESH_INTERVAL
+            if scheduler.is_due():
+                scheduler.prune()
+            if not ac._event_thread.is_alive():
+                logging.error("dc core event thread died, exiting now")
+                os._exit(1)
+            scheduler.wait(1)
     except Exception:
         logging.exception("bot received an unexpected error, exiting now")
         os._exit(1)
@@ -7,6 +7,7 @@ https://github.com/codespeaknet/sysadmin/blob/master/docs/postfix-virtual-domain
 from __future__ import print_function
 
 import sys
+import time
 
 import click
 import qrcode
@@ -21,7 +22,7 @@ import mailadm.db
 import mailadm.util
 
 from .bot import SetupPlugin, get_admbot_db_path
-from .conn import DBError, UserInfo
+from .conn import DBError
 from .mailcow import MailcowError
 
 option_dryrun = click.option(
@@ -203,14 +204,30 @@ def list_tokens(ctx):
     click.secho(mailadm.commands.list_tokens(db))
 
 
+@click.command()
+@click.option("--limit", type=int, default=10, help="how many queries to show")
+@click.option("--reset", is_flag=True, help="forget the statistics collected so far")
+@click.pass_context
+def top_queries(ctx, limit, reset):
+    """show the SQL queries which took the most time"""
+    db = get_mailadm_db(ctx)
+    if reset:
+        db.profiler.reset()
+        click.secho("query statistics were reset")
+        return
+    click.secho(mailadm.commands.top_queries(db, limit=limit))
+
+
 @click.command()
 @click.option("--token", type=str, default=None, help="name of token")
+@click.option("--after", type=str, default="", help="only list users after this address")
+@click.option("--limit", type=int, default=None, help="list at most this many users")
 @click.pass_context
-def list_users(ctx, token):
+def list_users(ctx, token, after, limit):
     """list users"""
     db = get_mailadm_db(ctx)
     with db.read_connection() as conn:
-        for user_info in conn.get_user_list(token=token):
+        for user_info in conn.iter_user_list(token=token, after=after, limit=limit):
             click.secho("{} [{}]".format(user_info.addr, user_info.token_name))
 
 
@@ -369,7 +386,8 @@ def init(ctx, web_endpoint, mail_domain, mailcow_endpoint, mailcow_token):
     "--token",
     type=str,
     default=None,
-    help="name of token. if not specified, automatically use first token matching addr",
+    help="name of token. if not specified, automatically use the token "
+    "with the longest prefix matching addr",
 )
 @option_dryrun
 @click.pass_context
@@ -405,15 +423,73 @@ def del_user(ctx, addr):
 
 @click.command()
 @option_dryrun
+@click.option("--batch-size", type=int, default=100, help="accounts deleted per mailcow request")
+@click.option(
+    "--max-accounts",
+    type=int,
+    default=None,
+    help="stop after checking this many accounts",
+)
+@click.option("--max-seconds", type=float, default=None, help="stop after this many seconds")
 @click.pass_context
-def prune(ctx, dryrun):
+def prune(ctx, dryrun, batch_size, max_accounts, max_seconds):
     """prune expired users from postfix and dovecot configurations"""
-    result = mailadm.commands.prune(get_mailadm_db(ctx), dryrun=dryrun)
+    result = mailadm.commands.prune(
+        get_mailadm_db(ctx),
+        dryrun=dryrun,
+        batch_size=batch_size,
+        max_accounts=max_accounts,
+        max_seconds=max_seconds,
+    )
+    failures = [msg for msg in result.get("message") if msg.startswith("failed")]
     for msg in result.get("message"):
-        if result.get("status") == "error":
-            ctx.fail(msg)
-        else:
+        if msg not in failures:
             click.secho(msg)
+    if result.get("status") == "error":
+        ctx.fail("\n".join(failures))
+
+
+@click.command()
+@click.pass_context
+def refresh_mailboxes(ctx):
+    """update the local mirror of the mailcow mailboxes."""
+    result = mailadm.commands.refresh_mailboxes(get_mailadm_db(ctx))
+    if result["status"] == "error":
+        ctx.fail(result["message"])
+    click.secho(result["message"])
+
+
+@click.command(name="export")
+@click.argument("path", type=click.File("w"), default="-")
+@click.pass_context
+def export_db(ctx, path):
+    """export tokens and users as newline-delimited JSON (to stdout by default)."""
+    result = mailadm.commands.export_ndjson(get_mailadm_db(ctx), path)
+    click.secho(result["message"], err=True)
+
+
+@click.command(name="import")
+@click.argument("path", type=click.File("r"), default="-")
+@click.option(
+    "--skip-mailcow",
+    is_flag=True,
+    help="only restore the mailadm database, don't create missing mailcow accounts",
+)
+@click.option("--batch-size", type=int, default=5000, help="rows per database transaction")
+@click.pass_context
+def import_db(ctx, path, skip_mailcow, batch_size):
+    """import tokens and users from newline-delimited JSON (from stdin by default)."""
+    result = mailadm.commands.import_ndjson(
+        get_mailadm_db(ctx),
+        path,
+        skip_mailcow=skip_mailcow,
+        batch_size=batch_size,
+    )
+    for msg in result["message"][:-1]:
+        click.secho(msg)
+    if result["status"] == "error":
+        ctx.fail(result["message"][-1])
+    click.secho(result["message"][-1])
 
 
 @click.command()
@@ -436,34 +512,17 @@ def web(ctx, debug):
 @click.command()
 @click.pass_context
 def migrate_db(ctx):
+    """rebuild the users table and remove deprecated config keys."""
     db = get_mailadm_db(ctx)
+    start = time.monotonic()
     with db.write_transaction() as conn:
-        conn.execute("PRAGMA foreign_keys=on;")
-
-        q = "SELECT addr, date, ttl, token_name from users"
-        users = [UserInfo(*args) for args in conn.execute(q).fetchall()]
-        q = "DROP TABLE users"
-        conn.execute(q)
-
-        conn.execute(
-            """
-                    CREATE TABLE users (
-                        addr TEXT PRIMARY KEY,
-                        date INTEGER,
-                        ttl INTEGER,
-                        token_name TEXT NOT NULL,
-                        FOREIGN KEY (token_name) REFERENCES tokens (name)
-                    )
-                """,
-        )
-        for u in users:
-            q = """INSERT INTO users (addr, date, ttl, token_name)
-                           VALUES (?, ?, ?, ?)"""
-            conn.execute(q, (u.addr, u.date, u.ttl, u.token_name))
+        mailadm.db.rebuild_users_table(conn)
 
         q = "DELETE FROM config WHERE name=?"
         conn.execute(q, ("vmail_user",))
         conn.execute(q, ("path_virtual_mailboxes",))
+        conn.bump_generation()
+    click.secho("migrated {} in {:.2f} seconds".format(db.path, time.monotonic() - start))
 
 
 mailadm_main.add_command(setup_bot)
@@ -478,8 +537,12 @@ mailadm_main.add_command(add_user)
 mailadm_main.add_command(del_user)
 mailadm_main.add_command(list_users)
 mailadm_main.add_command(prune)
+mailadm_main.add_command(refresh_mailboxes)
 mailadm_main.add_command(web)
 mailadm_main.add_command(migrate_db)
+mailadm_main.add_command(export_db)
+mailadm_main.add_command(top_queries)
+mailadm_main.add_command(import_db)
 
 
 if __name__ == "__main__":
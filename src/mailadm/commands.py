@@ -1,9 +1,13 @@
+import json
 import time
 
-from mailadm.conn import DBError
-from mailadm.gen_qr import gen_qr
+from mailadm.conn import DBError, get_expires_at
 from mailadm.mailcow import MailcowError
-from mailadm.util import get_human_readable_id
+from mailadm.profiling import format_top_queries
+from mailadm.util import gen_password, get_human_readable_id
+
+TOKEN_FIELDS = ("name", "token", "expiry", "prefix", "maxuse", "usecount")
+USER_FIELDS = ("addr", "date", "ttl", "token_name")
 
 
 def add_token(db, name, expiry, maxuse, prefix, token) -> dict:
@@ -29,7 +33,7 @@ def add_token(db, name, expiry, maxuse, prefix, token) -> dict:
 
 def add_user(db, token=None, addr=None, password=None, dryrun=False) -> {}:
     """Adds a new user to be managed by mailadm"""
-    with db.write_transaction() as conn:
+    with db.read_connection() as conn:
         if token is None:
             if "@" not in addr:
                 # there is probably a more pythonic solution to this.
@@ -46,54 +50,269 @@ def add_user(db, token=None, addr=None, password=None, dryrun=False) -> {}:
             token_info = conn.get_tokeninfo_by_name(token)
             if token_info is None:
                 return {"status": "error", "message": "token does not exist: {!r}".format(token)}
+    try:
+        user_info = db.add_email_account(token_info, addr=addr, password=password)
+    except DBError as e:
+        return {
+            "status": "error",
+            "message": "failed to add e-mail account {}: {}".format(addr, e),
+        }
+    except MailcowError as e:
+        return {
+            "status": "error",
+            "message": "failed to add e-mail account {}: {}".format(addr, e),
+        }
+    if dryrun:
+        # like in add_email_account, mailcow is called outside of the write transaction
+        with db.read_connection() as conn:
+            mailcow = conn.get_mailcow_connection()
+        mailcow.del_user_mailcow(user_info.addr)
+        with db.write_transaction() as conn:
+            conn.cancel_email_account(user_info)
+        return {"status": "dryrun", "message": user_info}
+    return {"status": "success", "message": user_info}
+
+
+def prune(db, dryrun=False, batch_size=100, max_accounts=None, max_seconds=None) -> {}:
+    """Delete expired users from mailcow and mailadm.
+
+    Overdue users are checked in batches of batch_size addresses, in the order
+    of their address: one mailcow request and one database transaction per
+    batch. Users which mailcow failed to delete are kept, so the next prune
+    tries again.
+
+    A run stops after checking max_accounts users or after max_seconds
+    seconds. Every batch saves a checkpoint, so the next run continues where
+    a previous one stopped or was interrupted; "done" in the result tells
+    whether all overdue users were checked.
+
+    Accounts which a crashed process left pending are confirmed or cancelled first.
+    """
+    start = time.monotonic()
+    with db.read_connection() as conn:
+        checkpoint = None if dryrun else conn.get_prune_checkpoint()
+        mailcow = conn.get_mailcow_connection()
+    result = {"status": "dryrun" if dryrun else "success", "message": [], "done": False}
+    if not dryrun:
         try:
-            user_info = conn.add_email_account(token_info, addr=addr, password=password)
-        except DBError as e:
-            return {
-                "status": "error",
-                "message": "failed to add e-mail account {}: {}".format(addr, e),
-            }
+            confirmed, cancelled = db.finish_pending_accounts()
         except MailcowError as e:
-            return {
-                "status": "error",
-                "message": "failed to add e-mail account {}: {}".format(addr, e),
-            }
+            result["status"] = "error"
+            result["message"].append("failed to finish pending accounts: %s" % (e,))
+        else:
+            for user_info in confirmed:
+                result["message"].append("confirmed pending account %s" % (user_info.addr,))
+            for user_info in cancelled:
+                result["message"].append("cancelled pending account %s" % (user_info.addr,))
+    if checkpoint is not None:
+        sysdate, after = checkpoint
+        result["message"].append("resuming prune after %s" % (after,))
+    else:
+        sysdate, after = int(time.time()), ""
+    result["sysdate"] = sysdate
+    checked = pruned = 0
+    # the mailbox listing is fetched at most once per run, when a batch needs it
+    last_logins = None
+    while True:
+        if max_accounts is not None and checked >= max_accounts:
+            break
+        if max_seconds is not None and time.monotonic() - start >= max_seconds:
+            break
+        limit = batch_size if max_accounts is None else min(batch_size, max_accounts - checked)
+        with db.read_connection() as conn:
+            overdue = conn.get_overdue_users(sysdate, after=after, limit=limit)
+            if not overdue:
+                result["done"] = True
+                break
+            if (
+                last_logins is None
+                and len(overdue) > conn.MAILBOX_LOOKUP_MAX
+                and not conn.mailboxes_fresh()
+            ):
+                last_logins = conn.get_all_last_logins()
+            batch = conn.get_expired_users(sysdate, overdue_users=overdue, last_logins=last_logins)
+        after = overdue[-1].addr
+        checked += len(overdue)
         if dryrun:
-            conn.delete_email_account(user_info.addr)
-            return {"status": "dryrun", "message": user_info}
-        return {"status": "success", "message": user_info}
+            for user_info in batch:
+                result["message"].append(
+                    "would delete %s (token %s)" % (user_info.addr, user_info.token_name),
+                )
+            continue
+        errors = {}
+        if batch:
+            try:
+                errors = mailcow.del_users_mailcow([user_info.addr for user_info in batch])
+            except MailcowError as e:
+                errors = {user_info.addr: e for user_info in batch}
+        deleted = [user_info for user_info in batch if user_info.addr not in errors]
+        try:
+            with db.write_transaction() as conn:
+                conn.del_users_db([user_info.addr for user_info in deleted])
+                conn.del_mailboxes_db([user_info.addr for user_info in deleted])
+                conn.set_prune_checkpoint(sysdate, after)
+        except DBError as e:
+            errors.update((user_info.addr, e) for user_info in deleted)
+        for user_info in batch:
+            if user_info.addr in errors:
+                result["status"] = "error"
+                result["message"].append(
+                    "failed to delete account %s: %s" % (user_info.addr, errors[user_info.addr]),
+                )
+            else:
+                pruned += 1
+                result["message"].append(
+                    "pruned %s (token %s)" % (user_info.addr, user_info.token_name),
+                )
+    if result["done"] and checkpoint is None and checked == 0:
+        result["message"].append("nothing to prune")
+        return result
+    if result["done"] and not dryrun:
+        with db.write_transaction() as conn:
+            conn.clear_prune_checkpoint()
+    duration = time.monotonic() - start
+    result["message"].append(
+        "checked %d and pruned %d accounts in %.1f seconds (%.1f accounts/sec)%s"
+        % (
+            checked,
+            pruned,
+            duration,
+            checked / duration if duration > 0 else 0,
+            "" if result["done"] else ", to be continued",
+        ),
+    )
+    return result
 
 
-def prune(db, dryrun=False) -> {}:
-    sysdate = int(time.time())
+def export_ndjson(db, out) -> dict:
+    """Write all tokens and users to a file object as newline-delimited JSON.
+
+    The rows are streamed from one consistent snapshot of the database.
+    """
+    counts = {"token": 0, "user": 0}
     with db.read_connection() as conn:
-        expired_users = conn.get_expired_users(sysdate)
-        if not expired_users:
-            return {"status": "success", "message": ["nothing to prune"]}
-    if dryrun:
-        result = {"status": "dryrun", "message": []}
-        for user_info in expired_users:
-            result["message"].append(
-                "would delete %s (token %s)" % (user_info.addr, user_info.token_name),
-            )
-    else:
-        result = {"status": "success", "message": []}
-        for user_info in expired_users:
+        conn.execute("BEGIN")
+        for kind, fields, table in (
+            ("token", TOKEN_FIELDS, "tokens"),
+            ("user", USER_FIELDS, "users"),
+        ):
+            q = "SELECT {} FROM {} ORDER BY rowid".format(", ".join(fields), table)
+            for row in conn.iterate(q):
+                record = {"type": kind}
+                record.update(zip(fields, row))
+                out.write(json.dumps(record) + "\n")
+                counts[kind] += 1
+    return {
+        "status": "success",
+        "message": "exported {} tokens and {} users".format(counts["token"], counts["user"]),
+    }
+
+
+def import_ndjson(db, lines, skip_mailcow=False, batch_size=5000) -> dict:
+    """Read tokens and users from newline-delimited JSON, as written by export_ndjson.
+
+    Rows are inserted in batches, one transaction per batch. Unless
+    skip_mailcow is set, mailcow accounts are created with a new password
+    for imported users which don't exist in mailcow yet.
+    """
+    result = {"status": "success", "message": []}
+    counts = {"token": 0, "user": 0}
+    batches = {"token": [], "user": []}
+    new_users = []
+
+    def flush(kind):
+        batch = batches[kind]
+        if not batch:
+            return
+        with db.write_transaction() as conn:
+            if kind == "token":
+                q = "INSERT INTO tokens ({}) VALUES (?, ?, ?, ?, ?, ?)".format(
+                    ", ".join(TOKEN_FIELDS),
+                )
+                conn.executemany(q, batch)
+                conn.bump_generation()
+            else:
+                q = "INSERT INTO users ({}, expires_at) VALUES (?, ?, ?, ?, ?)".format(
+                    ", ".join(USER_FIELDS),
+                )
+                conn.executemany(q, (row + (get_expires_at(row[1], row[2]),) for row in batch))
+        counts[kind] += len(batch)
+        batch.clear()
+
+    try:
+        for lineno, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
             try:
-                with db.read_connection() as conn:
-                    conn.get_mailcow_connection().del_user_mailcow(user_info.addr)
-                with db.write_transaction() as conn:
-                    conn.del_user_db(user_info.addr)
-            except (DBError, MailcowError) as e:
+                record = json.loads(line)
+                kind = record["type"]
+                if kind not in batches:
+                    raise ValueError("unknown type {!r}".format(kind))
+                fields = TOKEN_FIELDS if kind == "token" else USER_FIELDS
+                row = tuple(record[field] for field in fields)
+            except (ValueError, KeyError) as e:
+                return {
+                    "status": "error",
+                    "message": ["line {}: invalid record: {}".format(lineno, e)],
+                }
+            if kind == "user":
+                # users reference their token, so tokens have to be in the database first
+                flush("token")
+                new_users.append((row[0], row[3]))
+            batches[kind].append(row)
+            if len(batches[kind]) >= batch_size:
+                flush(kind)
+        flush("token")
+        flush("user")
+    except DBError as e:
+        return {"status": "error", "message": ["failed to import: {}".format(e)]}
+    result["message"].append(
+        "imported {} tokens and {} users".format(counts["token"], counts["user"]),
+    )
+
+    if not skip_mailcow and new_users:
+        with db.read_connection() as conn:
+            mailcow = conn.get_mailcow_connection()
+            try:
+                existing = {mcuser.addr for mcuser in conn.iter_mailcow_users()}
+            except MailcowError as e:
                 result["status"] = "error"
-                result["message"].append("failed to delete account %s: %s" % (user_info.addr, e))
+                result["message"].append("can't check mailcow users: {}".format(e))
+                return result
+        created = []
+        for addr, token_name in new_users:
+            if addr in existing:
                 continue
+            password = gen_password()
+            try:
+                mailcow.add_user_mailcow(addr, password, token_name)
+            except MailcowError as e:
+                result["status"] = "error"
+                result["message"].append("failed to add {} to mailcow: {}".format(addr, e))
+                continue
+            created.append((addr, token_name))
             result["message"].append(
-                "pruned %s (token %s)" % (user_info.addr, user_info.token_name),
+                "created {} in mailcow with password: {}".format(addr, password),
             )
+        if created:
+            with db.write_transaction() as conn:
+                for addr, token_name in created:
+                    conn.add_mailbox_db(addr, token_name)
     return result
 
 
+def refresh_mailboxes(db) -> dict:
+    """Update the local mirror of the mailcow mailboxes"""
+    try:
+        count, removed = db.refresh_mailboxes()
+    except (MailcowError, ValueError, OSError) as e:
+        return {"status": "error", "message": "failed to refresh mailboxes: {}".format(e)}
+    return {
+        "status": "success",
+        "message": "mirrored {} mailboxes, {} were removed".format(count, removed),
+    }
+
+
 def list_tokens(db) -> str:
     """Print token info for all tokens"""
     output = ["Existing tokens:\n"]
@@ -104,7 +323,35 @@ def list_tokens(db) -> str:
     return "\n".join(output)
 
 
-def qr_from_token(db, tokenname):
+def top_queries(db, limit=10) -> str:
+    """Print the SQL queries which took the most time, in all mailadm processes"""
+    entries = db.profiler.get_all_entries()
+    lines = ["Top queries by total time:\n", format_top_queries(entries, limit=limit)]
+    lines.append("\nWrite lock and connections per process:\n")
+    for pid, stats in sorted(db.profiler.get_all_process_stats().items()):
+        lock, pool = stats["lock"], stats["pool"]
+        lines.append(
+            "{pid}: {admitted} writers waited {total:.1f}ms in total, {max:.1f}ms max, "
+            "{timeouts} timed out, {waiting} waiting".format(
+                pid=pid,
+                admitted=lock["admitted"],
+                total=lock["wait_total"] * 1000,
+                max=lock["wait_max"] * 1000,
+                timeouts=lock["timeouts"],
+                waiting=lock["waiting"],
+            ),
+        )
+        lines.append(
+            "  connections: {opened} opened, {reused} reused, {closed} closed".format(**pool),
+        )
+    return "\n".join(lines)
+
+
+def qr_png_from_token(db, tokenname):
+    """Return the QR code image of a token as PNG data and the path of its cached file.
+
+    The image is only rendered if it isn't cached yet.
+    """
     with db.read_connection() as conn:
         token_info = conn.get_tokeninfo_by_name(tokenname)
         config = conn.config
@@ -112,9 +359,22 @@ def qr_from_token(db, tokenname):
     if token_info is None:
         return {"status": "error", "message": "token {!r} does not exist".format(tokenname)}
 
-    image = gen_qr(config, token_info)
-    fn = "docker-data/dcaccount-%s-%s.png" % (config.mail_domain, token_info.name)
-    image.save(fn)
+    png = db.qr_cache.get_png(config, token_info)
+    fn = db.qr_cache.get_path(config, token_info)
+    return {"status": "success", "png": png, "filename": fn}
+
+
+def qr_from_token(db, tokenname):
+    """Write the QR code image of a token to the docker-data directory."""
+    result = qr_png_from_token(db, tokenname)
+    if result["status"] == "error":
+        return result
+
+    with db.read_connection() as conn:
+        mail_domain = conn.config.mail_domain
+    fn = "docker-data/dcaccount-%s-%s.png" % (mail_domain, tokenname)
+    with open(fn, "wb") as f:
+        f.write(result["png"])
     return {"status": "success", "filename": fn}
 
 
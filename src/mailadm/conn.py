@@ -1,10 +1,15 @@
+import concurrent.futures
+import heapq
+import itertools
 import logging
 import sqlite3
+import sys
+import threading
 import time
 
 import mailadm.util
 
-from .mailcow import MailcowConnection, MailcowError
+from .mailcow import MailboxExistsError, MailcowConnection, MailcowError, MailcowUser
 
 
 class DBError(Exception):
@@ -23,25 +28,65 @@ class InvalidInputError(DBError):
     """Raised when user-specified input was invalid"""
 
 
+# rows which Connection.iterate() fetches at once
+ITERATE_BATCH_SIZE = 100
+
+
 class Connection:
-    def __init__(self, sqlconn, path, write):
+    # up to this many mailboxes are looked up one by one, for more all are listed
+    MAILBOX_LOOKUP_MAX = 20
+    MAILBOX_LOOKUP_WORKERS = 8
+
+    def __init__(
+        self,
+        sqlconn,
+        path,
+        write,
+        pool=None,
+        config_cache=None,
+        token_index=None,
+        profiler=None,
+        mailbox_max_age=None,
+        qr_cache=None,
+    ):
         self._sqlconn = sqlconn
         self.path_mailadm_db = path
         self._write = write
+        self._pool = pool
+        self._closed = False
+        self._config_cache = config_cache
+        self._token_index = token_index
+        self._profiler = profiler
+        # None: never use the mailbox mirror, always ask mailcow
+        self._mailbox_max_age = mailbox_max_age
+        self._qr_cache = qr_cache
+        self._config = None
+        self._generation_dirty = False
+        # seconds this connection waited for the write lock
+        self.lock_wait = 0.0
 
     def log(self, msg):
         logging.info("%s", msg)
 
     def close(self):
-        self._sqlconn.close()
+        if self._closed:
+            return
+        self._closed = True
+        if self._pool is not None:
+            self._pool.release(self._sqlconn, self._write)
+        else:
+            self._sqlconn.close()
 
     def commit(self):
         self._sqlconn.commit()
+        self._generation_dirty = False
 
     def rollback(self):
         self._sqlconn.rollback()
+        self._config = None
+        self._generation_dirty = False
 
-    def execute(self, query, params=()):
+    def _execute(self, query, params):
         cur = self.cursor()
         try:
             cur.execute(query, params)
@@ -49,6 +94,69 @@ class Connection:
             raise DBError(e)
         return cur
 
+    def _profile(self, query, start, rows):
+        if self._profiler is not None:
+            # label the statement with the name of the function which ran it
+            label = sys._getframe(2).f_code.co_name
+            self._profiler.record(label, query, time.perf_counter() - start, rows)
+
+    def execute(self, query, params=()):
+        start = time.perf_counter()
+        cur = self._execute(query, params)
+        # the rows of a SELECT are only known once they were fetched, see iterate()
+        self._profile(query, start, cur.rowcount if cur.rowcount >= 0 else None)
+        return cur
+
+    def iterate(self, query, params=()):
+        """Execute a query and yield its rows while they are fetched.
+
+        The profiler gets the rows and the time spent fetching them when the
+        iteration ends.
+        """
+        label = sys._getframe(1).f_code.co_name
+        start = time.perf_counter()
+        cur = self._execute(query, params)
+        return self._iterate(cur, label, query, time.perf_counter() - start)
+
+    def _iterate(self, cur, label, query, duration):
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = cur.fetchmany(ITERATE_BATCH_SIZE)
+                duration += time.perf_counter() - start
+                if not batch:
+                    return
+                rows += len(batch)
+                yield from batch
+        finally:
+            if self._profiler is not None:
+                self._profiler.record(label, query, duration, rows)
+
+    def fetchone(self, query, params=()):
+        """Execute a query and return its first row or None."""
+        start = time.perf_counter()
+        row = self._execute(query, params).fetchone()
+        self._profile(query, start, 0 if row is None else 1)
+        return row
+
+    def fetchall(self, query, params=()):
+        """Execute a query and return all rows."""
+        start = time.perf_counter()
+        rows = self._execute(query, params).fetchall()
+        self._profile(query, start, len(rows))
+        return rows
+
+    def executemany(self, query, seq_of_params):
+        start = time.perf_counter()
+        cur = self.cursor()
+        try:
+            cur.executemany(query, seq_of_params)
+        except sqlite3.IntegrityError as e:
+            raise DBError(e)
+        self._profile(query, start, cur.rowcount)
+        return cur
+
     def cursor(self):
         return self._sqlconn.cursor()
 
@@ -57,14 +165,21 @@ class Connection:
     #
     def get_dbversion(self):
         q = "SELECT value from config WHERE name='dbversion'"
-        c = self._sqlconn.cursor()
         try:
-            return int(c.execute(q).fetchone()[0])
+            return int(self.fetchone(q)[0])
         except sqlite3.OperationalError:
             return None
 
     @property
     def config(self):
+        if self._config_cache is None or self._generation_dirty:
+            # don't share a config which was changed in an uncommitted transaction
+            return self.read_config()
+        if self._config is None:
+            self._config = self._config_cache.get(self)
+        return self._config
+
+    def read_config(self):
         items = self.get_config_items()
         if items:
             d = dict(items)
@@ -85,9 +200,8 @@ class Connection:
 
     def get_config_items(self):
         q = "SELECT name, value from config"
-        c = self._sqlconn.cursor()
         try:
-            return c.execute(q).fetchall()
+            return self.fetchall(q)
         except sqlite3.OperationalError:
             return None
 
@@ -102,16 +216,28 @@ class Connection:
         ]
         assert name in ok, name
         q = "INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)"
-        self.cursor().execute(q, (name, value)).fetchone()
+        self.execute(q, (name, value))
+        self.bump_generation()
         return value
 
+    def get_generation(self):
+        """Return a counter which changes whenever the config or the tokens are changed."""
+        return self.fetchone("PRAGMA user_version")[0]
+
+    def bump_generation(self):
+        """Invalidate cached configs and tokens in all processes which use this database."""
+        generation = self.get_generation()
+        self.execute("PRAGMA user_version = %d" % (generation + 1,))
+        self._config = None
+        self._generation_dirty = True
+
     #
     # token management
     #
 
     def get_token_list(self):
         q = "SELECT name from tokens"
-        return [x[0] for x in self.execute(q).fetchall()]
+        return [x[0] for x in self.fetchall(q)]
 
     def add_token(self, name, token, expiry, prefix, maxuse=50):
         if "/" in name or "#" in name or "?" in name or "%" in name:
@@ -120,36 +246,49 @@ class Connection:
             raise InvalidInputError("token name can't start with a dot (.)")
         q = "INSERT INTO tokens (name, token, prefix, expiry, maxuse) VALUES (?, ?, ?, ?, ?)"
         self.execute(q, (name, token, prefix, expiry, int(maxuse)))
+        self.bump_generation()
         self.log("added token {!r}".format(name))
         return self.get_tokeninfo_by_name(name)
 
     def mod_token(self, name, expiry=None, prefix=None, maxuse=None):
         token_info = self.get_tokeninfo_by_name(name)
+        if token_info is None:
+            raise ValueError("token {!r} does not exist".format(name))
+        self.forget_qr(token_info)
         expiry = expiry if expiry is not None else token_info.expiry
         maxuse = maxuse if maxuse is not None else token_info.maxuse
         prefix = prefix if prefix is not None else token_info.prefix
         q = "REPLACE INTO tokens (name, token, prefix, expiry, maxuse) VALUES (?, ?, ?, ?, ?)"
         self.execute(q, (name, token_info.token, prefix, expiry, maxuse))
+        self.bump_generation()
         self.log("modified token {!r}".format(name))
         return self.get_tokeninfo_by_name(name)
 
     def del_token(self, name):
+        token_info = self.get_tokeninfo_by_name(name)
+        if token_info is not None:
+            self.forget_qr(token_info)
         q = "DELETE FROM tokens WHERE name=?"
-        c = self.cursor()
-        c.execute(q, (name,))
+        c = self.execute(q, (name,))
         if c.rowcount == 0:
             raise ValueError("token {!r} does not exist".format(name))
+        self.bump_generation()
         self.log("deleted token {!r}".format(name))
 
+    def forget_qr(self, token_info):
+        """Drop the cached QR code image of a token."""
+        if self._qr_cache is not None:
+            self._qr_cache.forget(self.config, token_info)
+
     def get_tokeninfo_by_name(self, name):
         q = TokenInfo._select_token_columns + "WHERE name = ?"
-        res = self.execute(q, (name,)).fetchone()
+        res = self.fetchone(q, (name,))
         if res is not None:
             return TokenInfo(self.config, *res)
 
     def get_tokeninfo_by_token(self, token):
         q = TokenInfo._select_token_columns + "WHERE token=?"
-        res = self.execute(q, (token,)).fetchone()
+        res = self.fetchone(q, (token,))
         if res is not None:
             return TokenInfo(self.config, *res)
 
@@ -158,29 +297,59 @@ class Connection:
             raise ValueError(
                 "addr {!r} does not use mail domain {!r}".format(addr, self.config.mail_domain),
             )
-        q = TokenInfo._select_token_columns
-        for res in self.execute(q).fetchall():
-            token_info = TokenInfo(self.config, *res)
-            if addr.startswith(token_info.prefix):
-                return token_info
+        name = self.get_token_prefixes().longest_match(addr)
+        if name is not None:
+            return self.get_tokeninfo_by_name(name)
+
+    def get_token_prefixes(self):
+        """Return a PrefixTrie which maps the prefixes of all tokens to their names."""
+        if self._token_index is None or self._generation_dirty:
+            return self.read_token_prefixes()
+        return self._token_index.get(self)
+
+    def read_token_prefixes(self):
+        trie = PrefixTrie()
+        for name, prefix in self.iterate("SELECT name, prefix FROM tokens ORDER BY rowid"):
+            trie.insert(prefix or "", name)
+        return trie
 
     #
     # user management
     #
 
     def add_email_account_tries(self, token_info, addr=None, password=None, tries=1):
-        """Try to add an email account."""
-        for i in range(1, tries + 1):
-            logging.info("Try %d to create an account", i)
-            try:
-                return self.add_email_account(token_info, addr=addr, password=password)
-            except (MailcowError, DBError):
-                if i >= tries:
-                    raise
+        """Try to add an email account, see add_email_account_tries()."""
+        return add_email_account_tries(self.add_email_account, token_info, addr, password, tries)
 
     def add_email_account(self, token_info, addr=None, password=None):
         """Add an email account to the mailcow server & mailadm
 
+        :param token_info: the token which authorizes the new user creation
+        :param addr: email address for the new account; randomly generated if omitted
+        :param password: password for the new account; randomly generated if omitted
+        :return: a UserInfo object with the database information about the new user, plus password
+        """
+        user_info = self.prepare_email_account(token_info, addr=addr, password=password)
+        try:
+            add_mailcow_account(
+                self.get_mailcow_connection(),
+                user_info,
+                check_exists=not self.mailboxes_fresh(),
+            )
+        except Exception:
+            self.cancel_email_account(user_info)
+            raise
+        self.confirm_email_account(user_info)
+        return user_info
+
+    def prepare_email_account(self, token_info, addr=None, password=None):
+        """Reserve an email account and a token use in mailadm, without invoking mailcow.
+
+        The account stays pending until it was created with add_mailcow_account()
+        and confirm_email_account(), or until cancel_email_account() gave the
+        reservation back because that failed. If the mailbox mirror is fresh,
+        it is checked for an existing mailbox here.
+
         :param token_info: the token which authorizes the new user creation
         :param addr: email address for the new account; randomly generated if omitted
         :param password: password for the new account; randomly generated if omitted
@@ -196,10 +365,8 @@ class Connection:
 
         if not self.is_valid_email(addr):
             raise InvalidInputError("not a valid email address")
-
-        # first check that mailcow doesn't have a user with that name already:
-        if self.get_mailcow_connection().get_user(addr):
-            raise MailcowError("account does already exist")
+        if self.mailboxes_fresh() and self.get_mailbox_db(addr) is not None:
+            raise MailboxExistsError()
 
         self.add_user_db(
             addr=addr,
@@ -207,16 +374,36 @@ class Connection:
             ttl=token_info.get_expiry_seconds(),
             token_name=token_info.name,
         )
+        self.add_mailbox_db(addr, token_info.name)
+        q = "INSERT INTO pending_accounts (addr, reserved_at) VALUES (?, ?)"
+        self.execute(q, (addr, int(time.time())))
 
         self.log("added addr {!r} with token {!r}".format(addr, token_info.name))
 
         user_info = self.get_user_by_addr(addr)
         user_info.password = password
+        return user_info
 
-        # seems that everything is fine so far, so let's invoke mailcow:
-        self.get_mailcow_connection().add_user_mailcow(addr, password, token_info.name)
+    def confirm_email_account(self, user_info):
+        """Finish prepare_email_account() after the mailcow account was created."""
+        self.execute("DELETE FROM pending_accounts WHERE addr=?", (user_info.addr,))
 
-        return user_info
+    def cancel_email_account(self, user_info):
+        """Undo prepare_email_account() after the mailcow account couldn't be created."""
+        self.del_user_db(user_info.addr)
+        self.del_mailboxes_db([user_info.addr])
+        self.release_token(user_info.token_name)
+
+    def is_pending_account(self, addr):
+        row = self.fetchone("SELECT 1 FROM pending_accounts WHERE addr=?", (addr,))
+        return row is not None
+
+    def get_pending_accounts(self, before):
+        """Return the users whose accounts were reserved before the timestamp before,
+        but never confirmed or cancelled, e.g. because the process died meanwhile."""
+        q = UserInfo._select_user_columns
+        q += "WHERE addr IN (SELECT addr FROM pending_accounts WHERE reserved_at < ?)"
+        return [UserInfo(*args) for args in self.fetchall(q, (before,))]
 
     def delete_email_account(self, addr):
         """Delete an email account from the mailcow server & mailadm.
@@ -225,22 +412,52 @@ class Connection:
         """
         self.get_mailcow_connection().del_user_mailcow(addr)
         self.del_user_db(addr)
+        self.del_mailboxes_db([addr])
 
     def add_user_db(self, addr, date, ttl, token_name):
         self.execute("PRAGMA foreign_keys=on;")
 
-        q = """INSERT INTO users (addr, date, ttl, token_name)
-               VALUES (?, ?, ?, ?)"""
-        self.execute(q, (addr, date, ttl, token_name))
-        self.execute("UPDATE tokens SET usecount = usecount + 1 WHERE name=?", (token_name,))
+        q = """INSERT INTO users (addr, date, ttl, token_name, expires_at)
+               VALUES (?, ?, ?, ?, ?)"""
+        self.execute(q, (addr, date, ttl, token_name, get_expires_at(date, ttl)))
+        try:
+            self.reserve_token(token_name)
+        except TokenExhaustedError:
+            self.execute("DELETE FROM users WHERE addr=?", (addr,))
+            raise
+
+    def reserve_token(self, token_name):
+        """Atomically use up one account creation of a token.
+
+        :raises TokenExhaustedError: if the token has reached its max-use limit
+        """
+        q = "UPDATE tokens SET usecount = usecount + 1 WHERE name=? AND usecount < maxuse"
+        if self.execute(q, (token_name,)).rowcount == 0:
+            raise TokenExhaustedError("token {!r} is exhausted".format(token_name))
+
+    def release_token(self, token_name):
+        """Give back an account creation which was reserved with reserve_token()."""
+        q = "UPDATE tokens SET usecount = usecount - 1 WHERE name=? AND usecount > 0"
+        self.execute(q, (token_name,))
 
     def del_user_db(self, addr):
         q = "DELETE FROM users WHERE addr=?"
         c = self.execute(q, (addr,))
         if c.rowcount == 0:
             raise UserNotFoundError("addr {!r} does not exist".format(addr))
+        self.execute("DELETE FROM pending_accounts WHERE addr=?", (addr,))
         self.log("deleted user {!r}".format(addr))
 
+    def del_users_db(self, addrs):
+        """Delete several users; addresses which don't exist are ignored.
+
+        :returns: how many users were deleted
+        """
+        q = "DELETE FROM users WHERE addr=?"
+        c = self.executemany(q, [(addr,) for addr in addrs])
+        self.log("deleted {} users".format(c.rowcount))
+        return c.rowcount
+
     def is_valid_email(self, addr):
         if not addr.endswith("@" + self.config.mail_domain):
             logging.error("address %s doesn't end with @%s", addr, self.config.mail_domain)
@@ -260,53 +477,332 @@ class Connection:
 
     def get_user_by_addr(self, addr):
         q = UserInfo._select_user_columns + "WHERE addr = ?"
-        args = self._sqlconn.execute(q, (addr,)).fetchone()
+        args = self.fetchone(q, (addr,))
         return UserInfo(*args)
 
-    def get_expired_users(self, sysdate):
-        q = UserInfo._select_user_columns + "WHERE (date + ttl) < ?"
-        overdue_users = []
+    def get_overdue_users(self, sysdate, after="", limit=-1):
+        """Return up to limit users whose expiry date is before sysdate, ordered
+        by address and starting after the address after. Pending accounts are left out."""
+        q = UserInfo._select_user_columns
+        q += "WHERE expires_at < ? AND addr > ? "
+        q += "AND addr NOT IN (SELECT addr FROM pending_accounts) ORDER BY addr LIMIT ?"
+        return [UserInfo(*args) for args in self.fetchall(q, (sysdate, after, limit))]
+
+    def get_expired_users(self, sysdate, overdue_users=None, last_logins=None):
+        """Return the users which are to be deleted at sysdate.
+
+        :param overdue_users: the users to check, e.g. from get_overdue_users();
+            by default all users whose expiry date is before sysdate
+        :param last_logins: the last logins of all mailcow users, e.g. from
+            get_all_last_logins(); by default they are looked up
+        """
+        min_ttl = mailadm.util.parse_expiry_code("27d")
         expired_users = []
-        for args in self._sqlconn.execute(q, (sysdate,)).fetchall():
-            overdue_users.append(UserInfo(*args))
+        if overdue_users is None:
+            q = UserInfo._select_user_columns + "WHERE expires_at < ? "
+            q += "AND addr NOT IN (SELECT addr FROM pending_accounts)"
+            overdue_users = [UserInfo(*args) for args in self.fetchall(q, (sysdate,))]
+        if last_logins is None:
+            last_logins = self.get_last_logins(
+                [user.addr for user in overdue_users if user.ttl >= min_ttl],
+            )
         for user in overdue_users:
             # expire users who were supposed to live less than 27 days
-            if user.ttl < mailadm.util.parse_expiry_code("27d"):
+            if user.ttl < min_ttl:
                 expired_users.append(user)
                 continue
-            mc_user = self.get_mailcow_connection().get_user(user.addr)
-            if mc_user is None:
+            if user.addr not in last_logins:
                 logging.warning("user %s doesn't exist in mailcow", user.addr)
                 continue
-            last_login = mc_user.last_login
+            last_login = last_logins[user.addr]
             # expire users who weren't online for longer than 25% of their TTL:
             if sysdate - last_login > user.ttl * 0.25:
                 expired_users.append(user)
         return expired_users
 
+    def get_prune_checkpoint(self):
+        """Return the (sysdate, addr) at which an unfinished prune stopped, or None."""
+        return self.fetchone("SELECT sysdate, addr FROM prune_checkpoint")
+
+    def set_prune_checkpoint(self, sysdate, addr):
+        q = "INSERT OR REPLACE INTO prune_checkpoint (id, sysdate, addr) VALUES (0, ?, ?)"
+        self.execute(q, (sysdate, addr))
+
+    def clear_prune_checkpoint(self):
+        self.execute("DELETE FROM prune_checkpoint")
+
+    def get_next_expiry(self, after=0):
+        """Return the earliest expiry date from after on, or None if no account expires."""
+        q = "SELECT min(expires_at) FROM users WHERE expires_at >= ?"
+        return self.fetchone(q, (after,))[0]
+
+    def get_last_logins(self, addrs):
+        """Return a dict which maps those of addrs which exist in mailcow to their last login.
+
+        A fresh mailbox mirror answers directly. Otherwise a few addresses are
+        looked up concurrently, and for more the mailbox listing is streamed
+        once and joined with them.
+        """
+        if not addrs:
+            return {}
+        if self.mailboxes_fresh():
+            last_logins = {}
+            for i in range(0, len(addrs), 500):
+                batch = addrs[i : i + 500]
+                q = "SELECT addr, last_login FROM mailboxes WHERE addr IN ({})".format(
+                    ", ".join("?" * len(batch)),
+                )
+                last_logins.update(self.fetchall(q, batch))
+            return last_logins
+        mailcow = self.get_mailcow_connection()
+        if len(addrs) > self.MAILBOX_LOOKUP_MAX:
+            wanted = set(addrs)
+            return {u.addr: u.last_login for u in mailcow.iter_users() if u.addr in wanted}
+        with concurrent.futures.ThreadPoolExecutor(self.MAILBOX_LOOKUP_WORKERS) as pool:
+            mcusers = list(pool.map(mailcow.get_user, addrs))
+        return {addr: u.last_login for addr, u in zip(addrs, mcusers) if u is not None}
+
+    def get_all_last_logins(self):
+        """Return a dict which maps all mailcow users to their last login."""
+        return {mcuser.addr: mcuser.last_login for mcuser in self.iter_mailcow_users()}
+
     def get_user_list(self, token=None):
-        q = UserInfo._select_user_columns
-        args = []
-        if token is not None:
-            q += "WHERE token_name=?"
-            args.append(token)
-        dbusers = [UserInfo(*args) for args in self._sqlconn.execute(q, args).fetchall()]
+        return list(self.iter_user_list(token=token))
+
+    def iter_user_list(self, token=None, after="", limit=None):
+        """Yield the users of mailadm and mailcow, ordered by address.
+
+        Users which only exist in mailcow are included unless a token is
+        given; users which don't exist in mailcow are marked in token_name.
+
+        :param token: only yield users of this token
+        :param after: only yield users whose address sorts after this one
+        :param limit: yield at most this many users
+        """
         try:
-            mcusers = self.get_mailcow_connection().get_user_list()
-            if not token:
-                for mcuser in mcusers:
-                    if mcuser.addr not in [dbuser.addr for dbuser in dbusers]:
-                        dbusers.append(UserInfo(mcuser.addr, 0, 0, "created in mailcow"))
-            for dbuser in dbusers:
-                if dbuser.addr not in [mcuser.addr for mcuser in mcusers]:
-                    dbuser.token_name = "WARNING: does not exist in mailcow"
+            mcaddrs = {mcuser.addr for mcuser in self.iter_mailcow_users()}
         except MailcowError as e:
             self.log("Can't check mailcow users: " + str(e))
-        return dbusers
+            mcaddrs = None
+        q = UserInfo._select_user_columns + "WHERE addr > ?"
+        args = [after]
+        if token is not None:
+            q += " AND token_name=?"
+            args.append(token)
+        users = (UserInfo(*args) for args in self.iterate(q + " ORDER BY addr", args))
+        if mcaddrs is not None and token is None:
+            mcusers = [
+                UserInfo(addr, 0, 0, "created in mailcow")
+                for addr in sorted(addr for addr in mcaddrs if addr > after)
+            ]
+            # for addresses in both, the mailadm user comes first and the other is skipped
+            merged = heapq.merge(users, mcusers, key=lambda user: user.addr)
+            users = (next(group) for _, group in itertools.groupby(merged, lambda u: u.addr))
+        for user in itertools.islice(users, limit):
+            if mcaddrs is not None and user.addr not in mcaddrs:
+                user.token_name = "WARNING: does not exist in mailcow"
+            yield user
 
     def get_mailcow_connection(self) -> MailcowConnection:
         return MailcowConnection(self.config.mailcow_endpoint, self.config.mailcow_token)
 
+    #
+    # chats of the bot
+    #
+
+    def get_support_groups(self):
+        """Return a dict which maps support user addresses to their support group chat ids."""
+        return dict(self.fetchall("SELECT addr, chat_id FROM support_groups"))
+
+    def get_support_group_id(self, addr):
+        row = self.fetchone("SELECT chat_id FROM support_groups WHERE addr=?", (addr,))
+        if row is not None:
+            return row[0]
+
+    def set_support_group_id(self, addr, chat_id):
+        q = "INSERT OR REPLACE INTO support_groups (addr, chat_id) VALUES (?, ?)"
+        self.execute(q, (addr, chat_id))
+
+    def del_support_group(self, addr):
+        self.execute("DELETE FROM support_groups WHERE addr=?", (addr,))
+
+    def set_support_groups(self, groups):
+        """Replace all support groups with a dict which maps addresses to chat ids."""
+        self.execute("DELETE FROM support_groups")
+        q = "INSERT INTO support_groups (addr, chat_id) VALUES (?, ?)"
+        self.executemany(q, groups.items())
+
+    def get_chat_roles(self):
+        """Return a dict which maps chat ids to the role of the group."""
+        return dict(self.fetchall("SELECT chat_id, role FROM chat_roles"))
+
+    def set_chat_role(self, chat_id, role):
+        q = "INSERT OR REPLACE INTO chat_roles (chat_id, role) VALUES (?, ?)"
+        self.execute(q, (chat_id, role))
+
+    #
+    # local mirror of the mailcow mailboxes
+    #
+
+    def get_mailboxes_refreshed(self):
+        """Return when the mailbox mirror was last refreshed from mailcow, or None."""
+        row = self.fetchone("SELECT value FROM mailboxes_state WHERE name='refreshed'")
+        if row is not None:
+            return row[0]
+
+    def mailboxes_fresh(self):
+        """Check whether reads may be served from the mailbox mirror."""
+        if self._mailbox_max_age is None:
+            return False
+        refreshed = self.get_mailboxes_refreshed()
+        return refreshed is not None and time.time() - refreshed <= self._mailbox_max_age
+
+    def get_mailcow_user(self, addr):
+        """Return the MailcowUser of addr or None, from the mirror if it is fresh."""
+        if not self.mailboxes_fresh():
+            return self.get_mailcow_connection().get_user(addr)
+        return self.get_mailbox_db(addr)
+
+    def iter_mailcow_users(self):
+        """Yield all mailcow users, from the mirror if it is fresh."""
+        if not self.mailboxes_fresh():
+            yield from self.get_mailcow_connection().iter_users()
+            return
+        for row in self.iterate("SELECT addr, last_login, token FROM mailboxes"):
+            yield mailbox_from_row(*row)
+
+    def get_mailbox_db(self, addr):
+        """Return the mirrored MailcowUser of addr, regardless of its age, or None."""
+        q = "SELECT addr, last_login, token FROM mailboxes WHERE addr=?"
+        row = self.fetchone(q, (addr,))
+        if row is not None:
+            return mailbox_from_row(*row)
+
+    def add_mailbox_db(self, addr, token_name, last_login=0):
+        """Record a mailbox which mailadm creates in mailcow."""
+        q = "INSERT OR REPLACE INTO mailboxes (addr, last_login, token, seen) VALUES (?, ?, ?, ?)"
+        self.execute(q, (addr, last_login, token_name, int(time.time())))
+
+    def del_mailboxes_db(self, addrs):
+        """Forget mailboxes which mailadm deleted from mailcow."""
+        self.executemany("DELETE FROM mailboxes WHERE addr=?", [(addr,) for addr in addrs])
+
+    def update_mailboxes_db(self, mcusers, seen):
+        """Insert or update mailboxes which mailcow listed during a refresh.
+
+        :param mcusers: MailcowUser objects from MailcowConnection.iter_users()
+        :param seen: when the refresh started
+        """
+        q = """INSERT INTO mailboxes (addr, last_login, token, seen) VALUES (?, ?, ?, ?)
+               ON CONFLICT (addr) DO UPDATE SET
+                   last_login=excluded.last_login, token=excluded.token, seen=excluded.seen"""
+        self.executemany(q, [(u.addr, u.last_login, u.token, seen) for u in mcusers])
+
+    def finish_mailboxes_refresh(self, seen):
+        """Remove mailboxes which weren't listed since the refresh started and
+        mark the mirror as fresh.
+
+        :returns: how many mailboxes were removed
+        """
+        c = self.execute("DELETE FROM mailboxes WHERE seen < ?", (seen,))
+        q = "INSERT OR REPLACE INTO mailboxes_state (name, value) VALUES ('refreshed', ?)"
+        self.execute(q, (seen,))
+        return c.rowcount
+
+
+def mailbox_from_row(addr, last_login, token):
+    tags = ["mailadm:" + token] if token is not None else []
+    return MailcowUser({"username": addr, "last_imap_login": last_login, "tags": tags})
+
+
+def get_expires_at(date, ttl):
+    """Return when an account expires; None for accounts of "never" expiring tokens."""
+    if date is None or ttl is None or ttl >= sys.maxsize - date:
+        return None
+    return date + ttl
+
+
+def add_email_account_tries(add_email_account, token_info, addr=None, password=None, tries=1):
+    """Try to add an email account with add_email_account(), up to tries times.
+
+    Only a random address which is taken already is retried, with a new
+    random address; other errors, e.g. an unavailable mailcow, are raised
+    immediately.
+    """
+    for i in range(1, tries + 1):
+        logging.info("Try %d to create an account", i)
+        try:
+            return add_email_account(token_info, addr=addr, password=password)
+        except (MailboxExistsError, DBError) as e:
+            if i >= tries or addr is not None or isinstance(e, TokenExhaustedError):
+                raise
+
+
+def add_mailcow_account(mailcow, user_info, check_exists=True):
+    """Create the mailcow account for a user from Connection.prepare_email_account().
+
+    :param mailcow: the MailcowConnection to use
+    :param user_info: the UserInfo of the new account, including its password
+    :param check_exists: whether to ask mailcow for an existing account first
+    """
+    # first check that mailcow doesn't have a user with that name already:
+    if check_exists and mailcow.get_user(user_info.addr):
+        raise MailboxExistsError()
+    mailcow.add_user_mailcow(user_info.addr, user_info.password, user_info.token_name)
+
+
+class GenerationCache:
+    """Process-wide cache of a value which is derived from the config or the tokens.
+
+    Every change to the config or the tokens bumps the database's user_version,
+    so a connection only needs to read that integer from the database header to
+    find out whether the cached value is still valid, even if another process
+    changed it.
+
+    :param load: called with a Connection to (re-)load the value
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self._generation = None
+        self._value = None
+        self.loads = 0
+
+    def get(self, conn):
+        generation = conn.get_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._value = self._load(conn)
+                self._generation = generation
+                self.loads += 1
+            return self._value
+
+
+class PrefixTrie:
+    """Character trie for finding the longest prefix of an address."""
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # the empty string never collides with a single character
+        node.setdefault("", value)
+
+    def longest_match(self, s):
+        """Return the value of the longest prefix of s, or None."""
+        node = self._root
+        match = node.get("")
+        for char in s:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get("", match)
+        return match
+
 
 class TokenInfo:
     _select_token_columns = "SELECT name, token, expiry, prefix, maxuse, usecount from tokens\n"
@@ -1,63 +1,471 @@
+import collections
 import contextlib
 import logging
 import os
+import random
 import sqlite3
+import sys
+import threading
 import time
+import weakref
 from pathlib import Path
 
-from .conn import Connection
+from .conn import (
+    Connection,
+    DBError,
+    GenerationCache,
+    add_email_account_tries,
+    add_mailcow_account,
+)
+from .gen_qr import QRCache
+from .profiling import QueryProfiler
 
 
 def get_db_path():
     db_path = os.environ.get("MAILADM_DB", "/mailadm/docker-data/mailadm.db")
-    try:
-        sqlite3.connect(db_path)
-    except sqlite3.OperationalError:
+    if not Path(db_path).parent.is_dir():
         raise RuntimeError("mailadm.db not found: MAILADM_DB not set")
     return Path(db_path)
 
 
-class DB:
-    def __init__(self, path, autoinit=True, debug=False):
+class PooledConnection(sqlite3.Connection):
+    """A sqlite connection which the ConnectionPool can track with weak references."""
+
+
+class ConnectionPool:
+    """Long-lived sqlite connections to one database file.
+
+    sqlite connections may only be used by the thread which created them,
+    so every thread keeps its own idle readers and writers. After a fork
+    (e.g. of gunicorn workers) the pool starts over and never hands out a
+    connection which was opened by the parent process. The child keeps
+    references to all of the parent's connections, so they are never
+    garbage collected and closed there, which would touch the database.
+
+    :param path: the path to the sqlite database
+    :param max_readers: how many idle read connections to keep per thread
+    :param max_writers: how many idle write connections to keep per thread
+    """
+
+    CACHED_STATEMENTS = 256
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, path, max_readers=4, max_writers=1):
         self.path = path
-        self.debug = debug
-        self.ensure_tables()
+        self.max_idle = {False: max_readers, True: max_writers}
+        self._stats_lock = threading.Lock()
+        self._stats = {"opened": 0, "reused": 0, "closed": 0}
+        self._connections = weakref.WeakSet()
+        self._forked = []
+        self._inherited = []
+        self._reset()
+        _pools.add(self)
 
-    def _get_connection(self, write=False, transaction=False, closing=False):
-        # we let the database serialize all writers at connection time
-        # to play it very safe (we don't have massive amounts of writes).
-        mode = "ro"
-        if write:
-            mode = "rw"
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def _before_fork(self):
+        # the connections of other threads are freed in the child before any
+        # code runs there, so they have to be referenced before the fork
+        with self._stats_lock:
+            self._forked = list(self._connections)
+
+    def _after_fork(self, child):
+        if child:
+            self._inherited.extend(self._forked)
+            self._connections = weakref.WeakSet()
+            self._reset()
+        self._forked = []
+
+    def _get_idle(self, write):
+        if self._pid != os.getpid():
+            # we are in a forked child, don't touch the parent's connections
+            self._reset()
+        idle = getattr(self._local, "idle", None)
+        if idle is None:
+            idle = self._local.idle = {False: [], True: []}
+        return idle[write]
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _open(self, write):
+        mode = "rw" if write else "ro"
         if not self.path.exists():
             mode = "rwc"
         uri = "file:%s?mode=%s" % (self.path, mode)
         sqlconn = sqlite3.connect(
             uri,
-            timeout=60,
-            isolation_level=None if transaction else "DEFERRED",
+            timeout=self.BUSY_TIMEOUT,
+            isolation_level="DEFERRED",
             uri=True,
+            cached_statements=self.CACHED_STATEMENTS,
+            factory=PooledConnection,
         )
-        if self.debug:
-            sqlconn.set_trace_callback(print)
-
+        with self._stats_lock:
+            self._connections.add(sqlconn)
         # Enable Write-Ahead Logging to avoid readers blocking writers and vice versa.
         if write:
             sqlconn.execute("PRAGMA journal_mode=wal")
+        return sqlconn
 
-        if transaction:
-            start_time = time.time()
+    def acquire(self, write):
+        """Return an idle sqlite connection of this thread or open a new one."""
+        idle = self._get_idle(write)
+        if idle:
+            self._count("reused")
+            return idle.pop()
+        self._count("opened")
+        return self._open(write)
+
+    def release(self, sqlconn, write):
+        """Give a sqlite connection back to the pool; uncommitted changes are discarded."""
+        if sqlconn.in_transaction:
+            sqlconn.rollback()
+        # the next user gets it like a fresh connection, without pragmas of the last one
+        sqlconn.execute("PRAGMA foreign_keys=off")
+        idle = self._get_idle(write)
+        if len(idle) < self.max_idle[write]:
+            idle.append(sqlconn)
+        else:
+            self._count("closed")
+            sqlconn.close()
+
+    def close(self):
+        """Close all idle connections of the current thread."""
+        for write in (False, True):
+            idle = self._get_idle(write)
+            while idle:
+                self._count("closed")
+                idle.pop().close()
+
+    def get_stats(self):
+        """Return how many connections were opened, reused and closed, and how
+        many are idle in the current thread."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["idle_readers"] = len(self._get_idle(False))
+        stats["idle_writers"] = len(self._get_idle(True))
+        return stats
+
+
+_pools = weakref.WeakSet()
+
+
+def _before_fork():
+    for pool in list(_pools):
+        pool._before_fork()
+
+
+def _after_fork(child):
+    for pool in list(_pools):
+        pool._after_fork(child)
+
+
+os.register_at_fork(
+    before=_before_fork,
+    after_in_parent=lambda: _after_fork(child=False),
+    after_in_child=lambda: _after_fork(child=True),
+)
+
+
+class WriterQueue:
+    """Admits writers to the database one at a time.
+
+    Writers of this process wait in arrival order, so gunicorn threads, the bot
+    thread and prune are served fairly. Against writers in other processes we
+    retry with exponential backoff and jitter until the deadline has passed.
+
+    :param deadline: how many seconds a writer may wait before giving up
+    """
+
+    BACKOFF_MIN = 0.005
+    BACKOFF_MAX = 0.25
+
+    def __init__(self, deadline=5.0):
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._busy = False
+        self._waiters = collections.deque()
+        self._stats = {"admitted": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    def begin(self, sqlconn):
+        """Start an immediate transaction on sqlconn once it's our turn.
+
+        :return: how many seconds we waited for the write lock
+        :raises sqlite3.OperationalError: if the deadline passed
+        """
+        start = time.monotonic()
+        deadline = start + self.deadline
+        self._enter(deadline)
+        try:
+            self._begin_immediate(sqlconn, deadline)
+        except sqlite3.OperationalError:
+            self.leave()
+            raise
+        wait = time.monotonic() - start
+        with self._lock:
+            self._stats["admitted"] += 1
+            self._stats["wait_total"] += wait
+            self._stats["wait_max"] = max(self._stats["wait_max"], wait)
+        if wait > 1:
+            logging.warning("DB: waited %.2f seconds for the write lock", wait)
+        return wait
+
+    def _enter(self, deadline):
+        with self._lock:
+            if not self._busy and not self._waiters:
+                self._busy = True
+                return
+            turn = threading.Event()
+            self._waiters.append(turn)
+        if turn.wait(deadline - time.monotonic()):
+            return
+        with self._lock:
+            if turn.is_set():
+                # leave() handed us the turn right after the timeout
+                return
+            self._waiters.remove(turn)
+            self._stats["timeouts"] += 1
+        raise sqlite3.OperationalError("database is locked by another writer of this process")
+
+    def leave(self):
+        """Hand the write lock to the next writer of this process."""
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._busy = False
+
+    def _begin_immediate(self, sqlconn, deadline):
+        # don't let sqlite's busy handler wait, we do the waiting ourselves
+        sqlconn.execute("PRAGMA busy_timeout = 0")
+        try:
+            delay = self.BACKOFF_MIN
             while 1:
                 try:
                     sqlconn.execute("begin immediate")
-                    break
+                    return
                 except sqlite3.OperationalError:
-                    # another thread may be writing, give it a chance to finish
-                    time.sleep(0.1)
-                    if time.time() - start_time > 5:
+                    # another process is writing, give it a chance to finish
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
                         # if it takes this long, something is wrong
+                        with self._lock:
+                            self._stats["timeouts"] += 1
                         raise
-        conn = Connection(sqlconn, self.path, write=write)
+                    time.sleep(min(random.uniform(delay / 2, delay), remaining))
+                    delay = min(delay * 2, self.BACKOFF_MAX)
+        finally:
+            sqlconn.execute("PRAGMA busy_timeout = %d" % (ConnectionPool.BUSY_TIMEOUT * 1000,))
+
+    def get_stats(self):
+        """Return how many writers were admitted or timed out, how long they
+        waited in total and at most, and how many are waiting right now."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["waiting"] = len(self._waiters)
+        return stats
+
+
+def create_users_table(conn, name="users"):
+    conn.execute(
+        """
+        CREATE TABLE {} (
+            addr TEXT PRIMARY KEY,
+            date INTEGER,
+            ttl INTEGER,
+            token_name TEXT NOT NULL,
+            expires_at INTEGER,
+            FOREIGN KEY (token_name) REFERENCES tokens (name)
+        )
+    """.format(name),
+    )
+
+
+# accounts of "never" expiring tokens have no expiry date
+EXPIRES_AT_SQL = "CASE WHEN ttl >= {} - date THEN NULL ELSE date + ttl END".format(sys.maxsize)
+
+
+def migrate_expires_at(conn):
+    """add users.expires_at"""
+    conn.execute("ALTER TABLE users ADD COLUMN expires_at INTEGER")
+    conn.execute("UPDATE users SET expires_at = " + EXPIRES_AT_SQL)
+    conn.execute("CREATE INDEX users_expires_at ON users (expires_at)")
+
+
+def create_mailboxes_tables(conn):
+    """Create the local mirror of the mailcow mailboxes."""
+    conn.execute(
+        """
+        CREATE TABLE mailboxes (
+            addr TEXT PRIMARY KEY,
+            last_login INTEGER,
+            token TEXT,
+            seen INTEGER NOT NULL
+        )
+    """,
+    )
+    conn.execute(
+        """
+        CREATE TABLE mailboxes_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """,
+    )
+
+
+def migrate_mailboxes(conn):
+    """add the mailboxes mirror"""
+    create_mailboxes_tables(conn)
+
+
+def create_prune_checkpoint_table(conn):
+    """Create the table which remembers how far an unfinished prune got."""
+    conn.execute(
+        """
+        CREATE TABLE prune_checkpoint (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            sysdate INTEGER NOT NULL,
+            addr TEXT NOT NULL
+        )
+    """,
+    )
+
+
+def migrate_prune_checkpoint(conn):
+    """add the prune checkpoint"""
+    create_prune_checkpoint_table(conn)
+
+
+def create_support_groups_table(conn):
+    """Create the table which maps support users to the bot's support group chats."""
+    conn.execute(
+        """
+        CREATE TABLE support_groups (
+            addr TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL
+        )
+    """,
+    )
+
+
+def migrate_support_groups(conn):
+    """add the support groups"""
+    create_support_groups_table(conn)
+
+
+def create_chat_roles_table(conn):
+    """Create the table which remembers what the groups of the bot are for."""
+    conn.execute(
+        """
+        CREATE TABLE chat_roles (
+            chat_id INTEGER PRIMARY KEY,
+            role TEXT NOT NULL
+        )
+    """,
+    )
+
+
+def migrate_chat_roles(conn):
+    """add the chat roles"""
+    create_chat_roles_table(conn)
+
+
+def create_pending_accounts_table(conn):
+    """Create the table of accounts which are reserved but not created in mailcow yet."""
+    conn.execute(
+        """
+        CREATE TABLE pending_accounts (
+            addr TEXT PRIMARY KEY,
+            reserved_at INTEGER NOT NULL
+        )
+    """,
+    )
+
+
+def migrate_pending_accounts(conn):
+    """add the pending accounts"""
+    create_pending_accounts_table(conn)
+
+
+def rebuild_users_table(conn):
+    """Recreate the users table with the current schema.
+
+    The rows are copied inside sqlite, so this needs neither a Python round
+    trip per user nor memory for all of them.
+    """
+    conn.execute("DROP TABLE IF EXISTS users_new")
+    create_users_table(conn, name="users_new")
+    conn.execute(
+        "INSERT INTO users_new (addr, date, ttl, token_name, expires_at) "
+        "SELECT addr, date, ttl, token_name, {} FROM users".format(EXPIRES_AT_SQL),
+    )
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX users_expires_at ON users (expires_at)")
+
+
+# creating an account in mailcow takes seconds; older pending accounts were abandoned
+PENDING_ACCOUNT_TIMEOUT = 10 * 60
+
+
+class DB:
+    def __init__(
+        self,
+        path,
+        autoinit=True,
+        debug=False,
+        write_deadline=5.0,
+        slow_query_threshold=0.5,
+        mailbox_max_age=30 * 60,
+    ):
+        self.path = path
+        self.debug = debug
+        # older mailbox mirrors are ignored and mailcow is asked instead
+        self.mailbox_max_age = mailbox_max_age
+        self.pool = ConnectionPool(path)
+        # log every statement in debug mode, otherwise only slow ones
+        self.profiler = QueryProfiler(
+            slow_query_threshold=slow_query_threshold,
+            stats_dir=Path(str(path) + ".querystats"),
+            log_all=debug,
+            process_stats=self.get_process_stats,
+        )
+        self.writers = WriterQueue(deadline=write_deadline)
+        self.config_cache = GenerationCache(Connection.read_config)
+        self.token_index = GenerationCache(Connection.read_token_prefixes)
+        self.qr_cache = QRCache(directory=Path(str(path) + ".qrcache"))
+        self.ensure_tables()
+
+    def _get_connection(self, write=False, transaction=False, closing=False):
+        sqlconn = self.pool.acquire(write)
+        sqlconn.isolation_level = None if transaction else "DEFERRED"
+
+        lock_wait = 0.0
+        if transaction:
+            # we let the database serialize all writers at connection time
+            # to play it very safe (we don't have massive amounts of writes).
+            try:
+                lock_wait = self.writers.begin(sqlconn)
+            except sqlite3.OperationalError:
+                self.pool.release(sqlconn, write)
+                raise
+        conn = Connection(
+            sqlconn,
+            self.path,
+            write=write,
+            pool=self.pool,
+            config_cache=self.config_cache,
+            token_index=self.token_index,
+            profiler=self.profiler,
+            mailbox_max_age=self.mailbox_max_age,
+            qr_cache=self.qr_cache,
+        )
+        conn.lock_wait = lock_wait
         if closing:
             conn = contextlib.closing(conn)
         return conn
@@ -74,6 +482,8 @@ class DB:
         else:
             conn.commit()
             conn.close()
+        finally:
+            self.writers.leave()
 
     def write_connection(self, closing=True):
         return self._get_connection(closing=closing, write=True)
@@ -81,6 +491,107 @@ class DB:
     def read_connection(self, closing=True):
         return self._get_connection(closing=closing, write=False)
 
+    def get_pool_stats(self):
+        return self.pool.get_stats()
+
+    def get_lock_stats(self):
+        return self.writers.get_stats()
+
+    def get_process_stats(self):
+        return {"lock": self.get_lock_stats(), "pool": self.get_pool_stats()}
+
+    def close(self):
+        """Close the idle database connections of the current thread."""
+        self.pool.close()
+
+    def add_email_account_tries(self, token_info, addr=None, password=None, tries=1):
+        """Try to add an email account, see mailadm.conn.add_email_account_tries()."""
+        return add_email_account_tries(self.add_email_account, token_info, addr, password, tries)
+
+    def add_email_account(self, token_info, addr=None, password=None):
+        """Add an email account to the mailcow server & mailadm.
+
+        Unlike Connection.add_email_account, this doesn't hold the database's
+        write lock during the mailcow requests: the account is reserved as
+        pending in one short transaction, and another one confirms it after
+        mailcow created the mailbox, or cancels it if mailcow failed. If this
+        process dies in between, finish_pending_accounts() cleans up later.
+
+        :param token_info: the token which authorizes the new user creation
+        :param addr: email address for the new account; randomly generated if omitted
+        :param password: password for the new account; randomly generated if omitted
+        :return: a UserInfo object with the database information about the new user, plus password
+        """
+        with self.write_transaction() as conn:
+            user_info = conn.prepare_email_account(token_info, addr=addr, password=password)
+            # prepare_email_account checked a fresh mirror for existing mailboxes already
+            check_exists = not conn.mailboxes_fresh()
+            mailcow = conn.get_mailcow_connection()
+        try:
+            add_mailcow_account(mailcow, user_info, check_exists=check_exists)
+        except Exception:
+            with self.write_transaction() as conn:
+                conn.cancel_email_account(user_info)
+            raise
+        with self.write_transaction() as conn:
+            conn.confirm_email_account(user_info)
+        return user_info
+
+    def finish_pending_accounts(self, max_age=PENDING_ACCOUNT_TIMEOUT):
+        """Confirm or cancel the accounts which are pending for more than max_age
+        seconds, because the process which reserved them died.
+
+        Each account is confirmed if mailcow has its mailbox, otherwise it is
+        cancelled, which gives its token use back.
+
+        :return: a (confirmed, cancelled) tuple of lists of UserInfo objects
+        """
+        with self.read_connection() as conn:
+            pending = conn.get_pending_accounts(before=int(time.time()) - max_age)
+            mailcow = conn.get_mailcow_connection()
+        confirmed = []
+        cancelled = []
+        for user_info in pending:
+            exists = mailcow.get_user(user_info.addr) is not None
+            with self.write_transaction() as conn:
+                # another process may have finished it meanwhile
+                if not conn.is_pending_account(user_info.addr):
+                    continue
+                if exists:
+                    conn.confirm_email_account(user_info)
+                    confirmed.append(user_info)
+                else:
+                    conn.cancel_email_account(user_info)
+                    cancelled.append(user_info)
+        return confirmed, cancelled
+
+    def refresh_mailboxes(self, batch_size=1000):
+        """Update the local mirror of the mailcow mailboxes from get/mailbox/all.
+
+        The listing is streamed and written in batches of batch_size mailboxes,
+        one short write transaction each, so the write lock is never held while
+        waiting for mailcow. Mailboxes which weren't listed are removed at the end.
+
+        :return: a (mailboxes, removed) tuple with how many mailboxes mailcow
+            listed and how many mirrored ones were gone
+        """
+        started = int(time.time())
+        with self.read_connection() as conn:
+            mailcow = conn.get_mailcow_connection()
+        count = 0
+        batch = []
+        for mcuser in mailcow.iter_users():
+            batch.append(mcuser)
+            if len(batch) >= batch_size:
+                with self.write_transaction() as conn:
+                    conn.update_mailboxes_db(batch, seen=started)
+                count += len(batch)
+                batch = []
+        with self.write_transaction() as conn:
+            conn.update_mailboxes_db(batch, seen=started)
+            removed = conn.finish_mailboxes_refresh(started)
+        return count + len(batch), removed
+
     def init_config(self, mail_domain, web_endpoint, mailcow_endpoint, mailcow_token):
         with self.write_transaction() as conn:
             conn.set_config("mail_domain", mail_domain)
@@ -96,13 +607,30 @@ class DB:
         with self.read_connection() as conn:
             return conn.config
 
-    CURRENT_DBVERSION = 1
+    CURRENT_DBVERSION = 7
+
+    # (dbversion, migration) pairs in ascending order; each migration upgrades
+    # the tables from the previous dbversion to its own.
+    MIGRATIONS = [
+        (2, migrate_expires_at),
+        (3, migrate_mailboxes),
+        (4, migrate_prune_checkpoint),
+        (5, migrate_support_groups),
+        (6, migrate_chat_roles),
+        (7, migrate_pending_accounts),
+    ]
 
     def ensure_tables(self):
         with self.read_connection() as conn:
-            if conn.get_dbversion():
+            if conn.get_dbversion() == self.CURRENT_DBVERSION:
                 return
         with self.write_transaction() as conn:
+            # check again, another process may have been faster
+            dbversion = conn.get_dbversion()
+            if dbversion:
+                self.migrate(conn, dbversion)
+                return
+
             logging.info("DB: Creating tables %s", self.path)
 
             conn.execute(
@@ -117,17 +645,13 @@ class DB:
                 )
             """,
             )
-            conn.execute(
-                """
-                CREATE TABLE users (
-                    addr TEXT PRIMARY KEY,
-                    date INTEGER,
-                    ttl INTEGER,
-                    token_name TEXT NOT NULL,
-                    FOREIGN KEY (token_name) REFERENCES tokens (name)
-                )
-            """,
-            )
+            create_users_table(conn)
+            conn.execute("CREATE INDEX users_expires_at ON users (expires_at)")
+            create_mailboxes_tables(conn)
+            create_prune_checkpoint_table(conn)
+            create_support_groups_table(conn)
+            create_chat_roles_table(conn)
+            create_pending_accounts_table(conn)
             conn.execute(
                 """
                 CREATE TABLE config (
@@ -137,3 +661,35 @@ class DB:
             """,
             )
             conn.set_config("dbversion", self.CURRENT_DBVERSION)
+
+    def migrate(self, conn, dbversion):
+        """Upgrade the tables from an older dbversion to the current one.
+
+        :param conn: a Connection inside a write transaction
+        :param dbversion: the dbversion of the tables
+        :return: a list of (dbversion, seconds) for each migration which ran
+        """
+        if dbversion > self.CURRENT_DBVERSION:
+            raise DBError(
+                "database version {} is newer than this mailadm's ({})".format(
+                    dbversion,
+                    self.CURRENT_DBVERSION,
+                ),
+            )
+        report = []
+        for version, migration in self.MIGRATIONS:
+            if version <= dbversion:
+                continue
+            start = time.monotonic()
+            migration(conn)
+            conn.set_config("dbversion", version)
+            duration = time.monotonic() - start
+            logging.info(
+                "DB: migrated %s to version %d (%s) in %.2f seconds",
+                self.path,
+                version,
+                migration.__doc__,
+                duration,
+            )
+            report.append((version, duration))
+        return report
@@ -1,94 +1,217 @@
+import collections
+import functools
+import hashlib
+import io
+import json
 import os
+import tempfile
+import threading
 
-import pkg_resources
 import qrcode
 from PIL import Image, ImageDraw, ImageFont
 
+# change this whenever gen_qr() draws something else, so cached images are rendered again
+QR_RENDER_VERSION = 2
 
-def gen_qr(config, token_info):
-    info = "{prefix}******@{domain} {expiry}\n".format(
-        domain=config.mail_domain,
-        prefix=token_info.prefix,
-        expiry=token_info.expiry,
-    )
-
-    steps = (
-        "1. Install https://get.delta.chat\n"
-        "2. From setup screen scan above QR code\n"
-        "3. Choose nickname & avatar\n"
-        "+ chat with any e-mail address ...\n"
-    )
-
-    # load QR code
-    url = token_info.get_qr_uri()
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=1,
-        border=1,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-
-    # paint all elements
-    ttf_path = pkg_resources.resource_filename("mailadm", "data/opensans-regular.ttf")
-    logo_red_path = pkg_resources.resource_filename("mailadm", "data/delta-chat-red.png")
-
-    assert os.path.exists(ttf_path), ttf_path
-    font_size = 16
-    font = ImageFont.truetype(font=ttf_path, size=font_size)
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+STEPS = (
+    "1. Install https://get.delta.chat\n"
+    "2. From setup screen scan above QR code\n"
+    "3. Choose nickname & avatar\n"
+    "+ chat with any e-mail address ...\n"
+)
+
+
+class QRRenderer:
+    """Draws the QR code images of tokens.
+
+    The font, the scaled logo and a template with everything which is the
+    same for all tokens are prepared once. Each image starts as a copy of the
+    template, and the QR code modules are drawn at their final size instead
+    of scaling up an image with one pixel per module.
 
-    num_lines = (info + steps).count("\n") + 2
+    :param data_dir: the directory with the font and the logo
+    """
 
-    size = width = 384
+    width = 384
+    font_size = 16
     qr_padding = 6
     text_margin_right = 12
-    text_height = font_size * num_lines
-    height = size + text_height + qr_padding * 2
-
-    image = Image.new("RGBA", (width, height), "white")
-
-    draw = ImageDraw.Draw(image)
-
-    qr_final_size = width - (qr_padding * 2)
-
-    # draw text
-    font_left, _font_top, font_right, _font_bottom = font.getbbox(info.strip())
-    font_width = font_right - font_left
-    info_pos = (width - font_width) // 2
-    draw.multiline_text(
-        (info_pos, size - qr_padding // 2),
-        info,
-        font=font,
-        fill="red",
-        align="right",
-    )
-    draw.multiline_text(
-        (text_margin_right, height - text_height + font_size * 1.0),
-        steps,
-        font=font,
-        fill="black",
-        align="left",
-    )
-
-    # paste QR code
-    image.paste(
-        qr_img.resize((qr_final_size, qr_final_size), resample=Image.NEAREST),
-        (qr_padding, qr_padding),
-    )
-
-    # paste black and white logo
-    # logo_bw_path = pkg_resources.resource_filename('mailadm', 'data/delta-chat-bw.png')
-    # logo_img = Image.open(logo_bw_path)
-    # logo = logo_img.resize((logo_width, logo_width), resample=Image.NEAREST)
-    # image.paste(logo, (0, qr_final_size + qr_padding), mask=logo)
-
-    # red background delta logo
-    logo2_img = Image.open(logo_red_path)
-    logo2_width = int(size / 6)
-    logo2 = logo2_img.resize((logo2_width, logo2_width), resample=Image.NEAREST)
-    pos = int((size / 2) - (logo2_width / 2))
-    image.paste(logo2, (pos, pos), mask=logo2)
-
-    return image
+
+    def __init__(self, data_dir=DATA_DIR):
+        ttf_path = os.path.join(data_dir, "opensans-regular.ttf")
+        assert os.path.exists(ttf_path), ttf_path
+        self.font = ImageFont.truetype(font=ttf_path, size=self.font_size)
+        logo_width = int(self.width / 6)
+        with Image.open(os.path.join(data_dir, "delta-chat-red.png")) as logo:
+            self.logo = logo.resize((logo_width, logo_width), resample=Image.NEAREST)
+        self.logo_pos = int((self.width / 2) - (logo_width / 2))
+        self.qr_size = self.width - (self.qr_padding * 2)
+
+        # the info line plus the steps, and two lines of space
+        num_lines = 1 + STEPS.count("\n") + 2
+        self.text_height = self.font_size * num_lines
+        self.height = self.width + self.text_height + self.qr_padding * 2
+        self.template = Image.new("RGBA", (self.width, self.height), "white")
+        ImageDraw.Draw(self.template).multiline_text(
+            (self.text_margin_right, self.height - self.text_height + self.font_size * 1.0),
+            STEPS,
+            font=self.font,
+            fill="black",
+            align="left",
+        )
+        # the pixel borders of the QR code modules, by the number of modules
+        self._edges = {}
+        # fonts are not safe to use from several threads at once
+        self._lock = threading.Lock()
+
+    def render(self, config, token_info):
+        """Return the QR code image of a token."""
+        info = "{prefix}******@{domain} {expiry}\n".format(
+            domain=config.mail_domain,
+            prefix=token_info.prefix,
+            expiry=token_info.expiry,
+        )
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_H,
+            border=1,
+        )
+        qr.add_data(token_info.get_qr_uri())
+        qr.make(fit=True)
+
+        with self._lock:
+            image = self.template.copy()
+            draw = ImageDraw.Draw(image)
+            font_left, _font_top, font_right, _font_bottom = self.font.getbbox(info.strip())
+            draw.multiline_text(
+                ((self.width - (font_right - font_left)) // 2, self.width - self.qr_padding // 2),
+                info,
+                font=self.font,
+                fill="red",
+                align="right",
+            )
+            self._draw_modules(draw, qr.get_matrix())
+            image.paste(self.logo, (self.logo_pos, self.logo_pos), mask=self.logo)
+        return image
+
+    def _draw_modules(self, draw, matrix):
+        """Draw each horizontal run of dark modules as one rectangle."""
+        edges = self._edges.get(len(matrix))
+        if edges is None:
+            count = len(matrix)
+            edges = [self.qr_padding + i * self.qr_size // count for i in range(count + 1)]
+            self._edges[count] = edges
+        for y, row in enumerate(matrix):
+            top, bottom = edges[y], edges[y + 1] - 1
+            x = 0
+            while x < len(row):
+                if not row[x]:
+                    x += 1
+                    continue
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                draw.rectangle((edges[start], top, edges[x] - 1, bottom), fill="black")
+
+
+@functools.lru_cache(maxsize=1)
+def get_renderer():
+    """Return the renderer of this process, which loads its assets on first use."""
+    return QRRenderer()
+
+
+def gen_qr(config, token_info):
+    return get_renderer().render(config, token_info)
+
+
+def get_qr_key(config, token_info) -> str:
+    """Return a hash of everything which the QR code image of a token shows."""
+    fields = [
+        QR_RENDER_VERSION,
+        config.mail_domain,
+        config.web_endpoint,
+        token_info.name,
+        token_info.token,
+        token_info.prefix,
+        token_info.expiry,
+    ]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+class QRCache:
+    """Cache of QR code images as PNG data, in memory and as files in a directory.
+
+    Images are stored under get_qr_key(), so a modified token or config never
+    finds an outdated image; forget() only frees the space of images which
+    won't be used anymore.
+
+    :param directory: where the PNG files are kept; None keeps them in memory only
+    :param max_entries: how many images are kept in memory
+    """
+
+    def __init__(self, directory=None, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self.renders = 0
+
+    def get_png(self, config, token_info) -> bytes:
+        """Return the QR code image of a token as PNG data, rendered only if it isn't cached."""
+        key = get_qr_key(config, token_info)
+        with self._lock:
+            png = self._images.get(key)
+            if png is not None:
+                self._images.move_to_end(key)
+                return png
+        path = self._get_file(key)
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                png = f.read()
+        else:
+            out = io.BytesIO()
+            gen_qr(config, token_info).save(out, format="PNG")
+            png = out.getvalue()
+            self.renders += 1
+            if path is not None:
+                self._write_file(path, png)
+        with self._lock:
+            self._images[key] = png
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+        return png
+
+    def get_path(self, config, token_info) -> str:
+        """Return the path of the cached PNG file of a token's QR code image."""
+        assert self.directory is not None
+        path = self._get_file(get_qr_key(config, token_info))
+        if not os.path.exists(path):
+            png = self.get_png(config, token_info)
+            if not os.path.exists(path):
+                self._write_file(path, png)
+        return path
+
+    def forget(self, config, token_info):
+        """Drop the image of a token, e.g. because the token is modified or deleted."""
+        key = get_qr_key(config, token_info)
+        with self._lock:
+            self._images.pop(key, None)
+        path = self._get_file(key)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _get_file(self, key):
+        if self.directory is not None:
+            return os.path.join(self.directory, key + ".png")
+
+    def _write_file(self, path, png):
+        # readers never see a partially written file
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as f:
+            f.write(png)
+        os.replace(f.name, path)
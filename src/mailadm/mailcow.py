@@ -1,8 +1,188 @@
+import collections
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
 from urllib.parse import quote
 
 import requests as r
+from requests.adapters import HTTPAdapter
 
+# the longest timeout for a mailcow request; shorter ones are used when mailcow is fast
 HTTP_TIMEOUT = 5
+# bytes read at once when streaming large responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class SharedSession:
+    """A requests.Session with a keep-alive connection pool, shared by all
+    MailcowConnections and threads of this process.
+
+    After a fork (e.g. of gunicorn workers) a new session is created, so
+    processes never share sockets.
+    """
+
+    # connections kept open per host; more are opened if needed but not kept
+    POOL_MAXSIZE = 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def get(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = r.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def get_stats(self):
+        """Return how many requests were sent and how many connections were
+        opened for them or reused."""
+        stats = {"requests": 0, "connections_opened": 0}
+        session = self.get()
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    stats["requests"] += pool.num_requests
+                    stats["connections_opened"] += pool.num_connections
+        stats["connections_reused"] = stats["requests"] - stats["connections_opened"]
+        return stats
+
+
+shared_session = SharedSession()
+
+
+class CircuitBreaker:
+    """Stops sending requests to mailcow while too many of them fail.
+
+    The breaker looks at the outcome of the last ``window`` requests. If at
+    least ``min_requests`` were made and more than ``failure_ratio`` of them
+    failed, it opens: requests are refused with CircuitOpenError for
+    ``reset_timeout`` seconds. Afterwards one trial request is let through;
+    if it succeeds the breaker closes, otherwise it stays open for another
+    ``reset_timeout`` seconds.
+
+    Only unreachable mailcows and HTTP 5xx answers count as failures; mailcow
+    rejecting a request (e.g. because an account exists) is a success here.
+    The latency of successful requests is tracked to adapt the timeout.
+    """
+
+    TIMEOUT_MIN = 2.0
+
+    def __init__(
+        self,
+        window=20,
+        min_requests=5,
+        failure_ratio=0.5,
+        reset_timeout=30.0,
+        max_timeout=HTTP_TIMEOUT,
+    ):
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._trial = False
+        # smoothed latency and its mean deviation, like TCP's retransmission timer
+        self._srtt = None
+        self._rttvar = None
+        self._stats = {"requests": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        """Check whether a request may be sent.
+
+        :raises CircuitOpenError: if the breaker is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                self._stats["requests"] += 1
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self._trial:
+                self._trial = True
+                self._stats["requests"] += 1
+                return
+            self._stats["rejected"] += 1
+        raise CircuitOpenError(max(remaining, 1))
+
+    def record(self, ok, latency=None):
+        """Record the outcome of a request which allow() let through.
+
+        :param ok: whether mailcow answered the request
+        :param latency: the seconds mailcow took to answer, if it did
+        """
+        with self._lock:
+            self._trial = False
+            self._outcomes.append(ok)
+            if ok:
+                if latency is not None:
+                    self._update_latency(latency)
+                if self._opened_at is not None:
+                    logging.info("mailcow: reachable again, closing the circuit breaker")
+                    self._opened_at = None
+                    self._outcomes.clear()
+                return
+            self._stats["failures"] += 1
+            if self._opened_at is not None:
+                # the trial request failed
+                self._opened_at = time.monotonic()
+                return
+            failures = self._outcomes.count(False)
+            total = len(self._outcomes)
+            if total >= self.min_requests and failures > self.failure_ratio * total:
+                logging.warning(
+                    "mailcow: %d of the last %d requests failed, opening the circuit breaker",
+                    failures,
+                    total,
+                )
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+
+    def _update_latency(self, latency):
+        if self._srtt is None:
+            self._srtt = latency
+            self._rttvar = latency / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - latency)
+            self._srtt = 0.875 * self._srtt + 0.125 * latency
+
+    def get_timeout(self):
+        """Return the timeout for the next request, based on the observed latency."""
+        with self._lock:
+            if self._srtt is None:
+                return self.max_timeout
+            timeout = self._srtt + 4 * self._rttvar
+        return min(max(timeout, self.TIMEOUT_MIN), self.max_timeout)
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def get_stats(self):
+        """Return how many requests were let through, failed or were rejected,
+        how often the breaker opened, and the current timeout."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = self._opened_at is not None
+        stats["timeout"] = self.get_timeout()
+        return stats
+
+
+circuit_breaker = CircuitBreaker()
 
 
 class MailcowConnection:
@@ -10,11 +190,83 @@ class MailcowConnection:
 
     :param mailcow_endpoint: the URL to the mailcow API
     :param mailcow_token: the access token to the mailcow API
+    :param session: the requests.Session to use; by default the one shared by this process
+    :param breaker: the CircuitBreaker to use; by default the one shared by this process
     """
 
-    def __init__(self, mailcow_endpoint, mailcow_token):
+    # how often a request is tried, if it fails in a way which is safe to retry
+    RETRY_ATTEMPTS = 3
+    RETRY_BACKOFF = 0.2
+    RETRY_BACKOFF_MAX = 2.0
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, mailcow_endpoint, mailcow_token, session=None, breaker=None):
         self.mailcow_endpoint = mailcow_endpoint
         self.auth = {"X-API-Key": mailcow_token}
+        self.session = session if session is not None else shared_session.get()
+        self.breaker = breaker if breaker is not None else circuit_breaker
+
+    def _request(self, method, path, idempotent=True, timeout=None, **kwargs):
+        """Send a request to mailcow through the circuit breaker.
+
+        Failures are retried with exponential backoff and jitter if that is
+        safe: requests which never reached mailcow always, others only if
+        they are idempotent.
+
+        :param timeout: a fixed timeout; by default it adapts to mailcow's latency for
+            idempotent requests and is HTTP_TIMEOUT for others, because a request which
+            timed out may still have changed something in mailcow
+        :raises CircuitOpenError: if mailcow failed too often recently
+        :raises MailcowError: if mailcow answered with an HTTP 5xx status
+        """
+        url = self.mailcow_endpoint + path
+        if timeout is None and not idempotent:
+            timeout = HTTP_TIMEOUT
+        delay = self.RETRY_BACKOFF
+        for attempt in range(1, self.RETRY_ATTEMPTS + 1):
+            self.breaker.allow()
+            start = time.monotonic()
+            try:
+                result = self.session.request(
+                    method,
+                    url,
+                    headers=self.auth,
+                    timeout=timeout if timeout is not None else self.breaker.get_timeout(),
+                    **kwargs,
+                )
+            except (r.exceptions.ConnectionError, r.exceptions.Timeout) as e:
+                self.breaker.record(False)
+                never_sent = isinstance(e, r.exceptions.ConnectTimeout)
+                if attempt >= self.RETRY_ATTEMPTS or not (idempotent or never_sent):
+                    raise
+            except Exception:
+                # e.g. a broken response; every request allow() let through must be
+                # recorded, or a trial request would keep the breaker open forever
+                self.breaker.record(False)
+                raise
+            else:
+                if result.status_code < 500:
+                    # a fixed timeout means an unusual request, don't learn from it
+                    latency = time.monotonic() - start if timeout is None else None
+                    self.breaker.record(True, latency)
+                    return result
+                self.breaker.record(False)
+                result.close()
+                if (
+                    attempt >= self.RETRY_ATTEMPTS
+                    or not idempotent
+                    or result.status_code not in self.RETRY_STATUS
+                ):
+                    raise MailcowError(
+                        "mailcow answered {} {} with HTTP {}".format(
+                            method,
+                            path,
+                            result.status_code,
+                        ),
+                    )
+            logging.info("mailcow: try %d of %s %s failed, retrying", attempt, method, path)
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self.RETRY_BACKOFF_MAX)
 
     def add_user_mailcow(self, addr, password, token, quota=0):
         """HTTP Request to add a user to the mailcow instance.
@@ -24,7 +276,6 @@ class MailcowConnection:
         :param token: the mailadm token used for account creation
         :param quota: the maximum mailbox storage in MB. default: unlimited
         """
-        url = self.mailcow_endpoint + "add/mailbox"
         payload = {
             "local_part": addr.split("@")[0],
             "domain": addr.split("@")[1],
@@ -37,7 +288,7 @@ class MailcowConnection:
             "tls_enforce_out": False,
             "tags": ["mailadm:" + token],
         }
-        result = r.post(url, json=payload, headers=self.auth, timeout=HTTP_TIMEOUT)
+        result = self._request("POST", "add/mailbox", idempotent=False, json=payload)
         if not isinstance(result.json(), list) or result.json()[0].get("type") != "success":
             raise MailcowError(result.json())
 
@@ -46,16 +297,56 @@ class MailcowConnection:
 
         :param addr: the email account to be deleted
         """
-        url = self.mailcow_endpoint + "delete/mailbox"
-        result = r.post(url, json=[addr], headers=self.auth, timeout=HTTP_TIMEOUT)
+        errors = self.del_users_mailcow([addr])
+        if addr in errors:
+            raise errors[addr]
+
+    def del_users_mailcow(self, addrs):
+        """HTTP Request to delete several users from the mailcow instance at once.
+
+        Addresses which mailcow has no mailbox for count as deleted.
+
+        :param addrs: the email accounts to be deleted
+        :returns: a dict mapping each address which could not be deleted to its MailcowError
+        """
+        addrs = list(addrs)
+        if not addrs:
+            return {}
+        result = self._request("POST", "delete/mailbox", idempotent=False, json=addrs)
         json = result.json()
-        if not isinstance(json, list) or json[0].get("type" != "success"):
+        if not isinstance(json, list):
             raise MailcowError(json)
+        # mailcow answers with one message per address, e.g.
+        # {"type": "success", "msg": ["mailbox_removed", "user@example.org"]}
+        deleted = set()
+        errors = {}
+        unattributed = []
+        for entry in json:
+            msg = entry.get("msg") if isinstance(entry, dict) else None
+            addr = msg[1] if isinstance(msg, list) and len(msg) > 1 else None
+            if isinstance(entry, dict) and entry.get("type") == "success":
+                deleted.add(addr)
+            elif addr in addrs:
+                errors[addr] = MailcowError(entry)
+            else:
+                unattributed.append(entry)
+        if unattributed:
+            for addr in addrs:
+                if addr not in deleted and addr not in errors:
+                    errors[addr] = MailcowError(unattributed)
+        # mailcow refuses to delete a mailbox which doesn't exist, e.g. with "access_denied"
+        for addr in list(errors):
+            try:
+                if self.get_user(addr) is None:
+                    del errors[addr]
+            except (MailcowError, r.exceptions.RequestException):
+                # mailcow is unavailable, the other addresses can't be checked either
+                break
+        return errors
 
     def get_user(self, addr):
         """HTTP Request to get a specific mailcow user (not only mailadm-generated ones)."""
-        url = self.mailcow_endpoint + "get/mailbox/" + quote(addr, safe="")
-        result = r.get(url, headers=self.auth, timeout=HTTP_TIMEOUT)
+        result = self._request("GET", "get/mailbox/" + quote(addr, safe=""))
         json = result.json()
         if json == {}:
             return None
@@ -71,30 +362,124 @@ class MailcowConnection:
 
     def get_user_list(self):
         """HTTP Request to get all mailcow users (not only mailadm-generated ones)."""
-        url = self.mailcow_endpoint + "get/mailbox/all"
+        return list(self.iter_users())
+
+    def iter_users(self):
+        """Yield all mailcow users (not only mailadm-generated ones) while they are downloaded.
 
+        The response is decoded one mailbox at a time, so memory use doesn't
+        grow with the number of mailboxes.
+        """
         # Using larger timeout here than for other requests,
         # because some mailcow instances may have a large number of users.
-        result = r.get(url, headers=self.auth, timeout=30)
-        json = result.json()
-        if json == {}:
-            return []
-        if isinstance(json, dict):
-            if json.get("type") == "error":
-                raise MailcowError(json)
-        return [MailcowUser(user) for user in json]
+        result = self._request("GET", "get/mailbox/all", timeout=30, stream=True)
+        with result:
+            if result.encoding is None:
+                result.encoding = "utf-8"
+            chunks = result.iter_content(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True)
+            for item in iter_json_list(chunks):
+                if isinstance(item, dict) and "username" in item:
+                    yield MailcowUser(item)
+                elif isinstance(item, dict) and item.get("type") == "error":
+                    raise MailcowError(item)
 
 
 class MailcowUser(object):
+    """The fields of a mailcow mailbox which mailadm uses."""
+
+    __slots__ = ("addr", "quota", "last_login", "token")
+
     def __init__(self, json):
         self.addr = json.get("username")
         self.quota = json.get("quota")
         self.last_login = json.get("last_imap_login")
+        self.token = None
         for tag in json.get("tags", []):
             if "mailadm:" in tag:
                 self.token = tag.removeprefix("mailadm:")
                 break
 
 
+_whitespace = re.compile(r"\s*")
+
+
+def iter_json_list(chunks):
+    """Decode a JSON document which arrives as an iterable of text chunks.
+
+    If the document is a list, each item is yielded as soon as it is complete.
+    Any other document is yielded as a whole once all chunks have arrived.
+    Raises ValueError if the document isn't valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+
+    def more():
+        nonlocal buf, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek():
+        # return the next non-whitespace character, or "" at the end of the document
+        nonlocal pos
+        while True:
+            pos = _whitespace.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return ""
+
+    if peek() != "[":
+        while more():
+            pass
+        yield json.loads(buf[pos:])
+        return
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        peek()
+        while True:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                break
+            except ValueError:
+                # the item is incomplete (or invalid, which shows at the end)
+                if not more():
+                    raise
+        yield item
+        char = peek()
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError("expected ',' or ']' at offset %d, got %r" % (pos, char))
+        pos += 1
+
+
 class MailcowError(Exception):
     """This is thrown if a Mailcow operation fails."""
+
+
+class MailboxExistsError(MailcowError):
+    """mailcow has a mailbox with the address already."""
+
+    def __init__(self, msg="account does already exist"):
+        super().__init__(msg)
+
+
+class CircuitOpenError(MailcowError):
+    """mailcow failed too often recently, so requests are refused without trying.
+
+    :param retry_after: in how many seconds mailcow will be tried again
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = math.ceil(retry_after)
+        super().__init__(
+            "mailcow is unavailable, trying again in {} seconds".format(self.retry_after),
+        )
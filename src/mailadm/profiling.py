@@ -0,0 +1,199 @@
+"""
+per-statement timing of the SQL queries mailadm runs
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class QueryProfiler:
+    """Aggregates timing, row counts and call sites of the queries of this process.
+
+    Statistics are kept per (call site, statement) in a latency histogram. If a
+    stats_dir is given, they are written there every FLUSH_INTERVAL seconds, so
+    that ``mailadm top-queries`` can show the queries of the web workers and the
+    bot as well.
+
+    :param slow_query_threshold: log queries which take longer than this many seconds
+    :param stats_dir: directory to write the statistics of this process to
+    :param log_all: log every query, not only slow ones
+    :param process_stats: returns a dict with more statistics of this process,
+        e.g. about locks, which are written to stats_dir with the queries
+    """
+
+    # upper bounds of the histogram buckets in seconds; the last bucket is open
+    BUCKETS = (0.001, 0.01, 0.1, 1.0)
+    FLUSH_INTERVAL = 30
+
+    def __init__(self, slow_query_threshold=0.5, stats_dir=None, log_all=False, process_stats=None):
+        self.slow_query_threshold = slow_query_threshold
+        self.stats_dir = Path(stats_dir) if stats_dir is not None else None
+        self.log_all = log_all
+        self.process_stats = process_stats
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._stats = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, label, query, duration, rows=None):
+        """Record one statement.
+
+        :param label: the call site, e.g. the name of the Connection method
+        :param query: the SQL statement
+        :param duration: how many seconds the statement took
+        :param rows: how many rows it returned or changed; None if unknown
+        """
+        if self.log_all:
+            logging.info("DB: %s took %.2fms: %s", label, duration * 1000, query.strip())
+        elif self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            logging.warning(
+                "DB: slow query in %s took %.3fs (%s rows): %s",
+                label,
+                duration,
+                rows,
+                query.strip(),
+            )
+        snapshot = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # don't count the queries of our parent process twice
+                self._reset()
+            entry = self._stats.get((label, query))
+            if entry is None:
+                entry = self._stats[(label, query)] = new_entry(label, query)
+            entry["calls"] += 1
+            entry["total"] += duration
+            entry["max"] = max(entry["max"], duration)
+            if rows is not None and rows >= 0:
+                entry["rows"] += rows
+            entry["histogram"][bisect.bisect_left(self.BUCKETS, duration)] += 1
+            now = time.monotonic()
+            if self.stats_dir is not None and now - self._last_flush > self.FLUSH_INTERVAL:
+                self._last_flush = now
+                snapshot = self.get_entries_locked()
+        if snapshot is not None:
+            self.write(snapshot)
+
+    def get_entries_locked(self):
+        return [dict(entry, histogram=list(entry["histogram"])) for entry in self._stats.values()]
+
+    def get_entries(self):
+        """Return the statistics of this process as a list of dicts."""
+        with self._lock:
+            return self.get_entries_locked()
+
+    def write(self, entries):
+        self._write_file("%d.json" % (self._pid,), entries)
+        if self.process_stats is not None:
+            self._write_file("%d.process" % (self._pid,), self.process_stats())
+
+    def _write_file(self, name, data):
+        path = self.stats_dir.joinpath(name)
+        tmp_path = self.stats_dir.joinpath(name + ".tmp")
+        try:
+            self.stats_dir.mkdir(exist_ok=True)
+            tmp_path.write_text(json.dumps(data))
+            tmp_path.replace(path)
+        except OSError as e:
+            logging.warning("DB: could not write query statistics to %s: %s", path, e)
+
+    def get_all_process_stats(self):
+        """Return a dict which maps the pids of this and other processes to their process_stats."""
+        all_stats = {}
+        if self.stats_dir is not None and self.stats_dir.is_dir():
+            for path in self.stats_dir.glob("*.process"):
+                try:
+                    all_stats[int(path.stem)] = json.loads(path.read_text())
+                except (OSError, ValueError) as e:
+                    logging.warning("DB: could not read process statistics from %s: %s", path, e)
+        if self.process_stats is not None:
+            all_stats[os.getpid()] = self.process_stats()
+        return all_stats
+
+    def get_all_entries(self):
+        """Return the statistics of this process merged with those written by others."""
+        merged = {}
+        entries = []
+        if self.stats_dir is not None and self.stats_dir.is_dir():
+            for path in self.stats_dir.glob("*.json"):
+                if path.stem == str(self._pid):
+                    continue
+                try:
+                    entries.extend(json.loads(path.read_text()))
+                except (OSError, ValueError) as e:
+                    logging.warning("DB: could not read query statistics from %s: %s", path, e)
+        entries.extend(self.get_entries())
+        for entry in entries:
+            key = (entry["label"], entry["query"])
+            if key not in merged:
+                merged[key] = new_entry(entry["label"], entry["query"])
+            merged_entry = merged[key]
+            merged_entry["calls"] += entry["calls"]
+            merged_entry["total"] += entry["total"]
+            merged_entry["max"] = max(merged_entry["max"], entry["max"])
+            merged_entry["rows"] += entry["rows"]
+            for i, count in enumerate(entry["histogram"]):
+                merged_entry["histogram"][i] += count
+        return list(merged.values())
+
+    def reset(self):
+        """Forget the statistics of this process and those written by others."""
+        with self._lock:
+            self._reset()
+        if self.stats_dir is not None and self.stats_dir.is_dir():
+            for pattern in ("*.json", "*.process"):
+                for path in self.stats_dir.glob(pattern):
+                    path.unlink()
+
+
+def new_entry(label, query):
+    return {
+        "label": label,
+        "query": query,
+        "calls": 0,
+        "total": 0.0,
+        "max": 0.0,
+        "rows": 0,
+        "histogram": [0] * (len(QueryProfiler.BUCKETS) + 1),
+    }
+
+
+def format_top_queries(entries, limit=10):
+    """Format the queries which took the most time in total as a table."""
+    entries = sorted(entries, key=lambda entry: entry["total"], reverse=True)[:limit]
+    if not entries:
+        return "no queries recorded yet"
+    bucket_names = ["<%gms" % (bound * 1000,) for bound in QueryProfiler.BUCKETS]
+    bucket_names.append(">=%gms" % (QueryProfiler.BUCKETS[-1] * 1000,))
+    lines = []
+    for entry in entries:
+        query = " ".join(entry["query"].split())
+        if len(query) > 60:
+            query = query[:57] + "..."
+        lines.append(
+            "{label}: {calls} calls, {total:.1f}ms total, {avg:.2f}ms avg, "
+            "{max:.2f}ms max, {rows} rows".format(
+                label=entry["label"],
+                calls=entry["calls"],
+                total=entry["total"] * 1000,
+                avg=entry["total"] * 1000 / entry["calls"],
+                max=entry["max"] * 1000,
+                rows=entry["rows"],
+            ),
+        )
+        lines.append("  " + query)
+        histogram = [
+            "%s:%d" % (name, count)
+            for name, count in zip(bucket_names, entry["histogram"])
+            if count
+        ]
+        lines.append("  " + " ".join(histogram))
+    return "\n".join(lines)
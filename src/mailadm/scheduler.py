@@ -0,0 +1,108 @@
+"""
+deciding when the bot prunes expired accounts
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+from mailadm.commands import prune
+from mailadm.mailcow import MailcowError
+
+
+class PruneScheduler:
+    """Prunes expired accounts when the next account expires, not in fixed intervals.
+
+    The earliest expiry is read from the database with one indexed query, no
+    mailcow request. It is re-read at least every ``poll_interval`` seconds,
+    because other processes (e.g. the web API) add accounts which may expire
+    earlier, and right away after trigger() was called.
+
+    Accounts which are overdue but were kept because they are still in use
+    are checked again every ``recheck_interval`` seconds; if a prune failed,
+    it is retried after ``retry_interval`` seconds.
+
+    A prune runs for at most ``max_seconds`` seconds, so the bot loop isn't
+    blocked by a large backlog; an unfinished prune is continued right away.
+
+    :param db: the mailadm DB
+    :param poll_interval: how often to look for accounts added by other processes
+    :param recheck_interval: how often to check overdue accounts which are still in use
+    :param retry_interval: when to prune again after a prune failed
+    :param max_seconds: the time budget of one prune
+    """
+
+    def __init__(
+        self,
+        db,
+        poll_interval=60,
+        recheck_interval=60 * 60,
+        retry_interval=10 * 60,
+        max_seconds=30,
+    ):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.recheck_interval = recheck_interval
+        self.retry_interval = retry_interval
+        self.max_seconds = max_seconds
+        self._wakeup = threading.Event()
+        self._last_prune = 0
+        self._retry_at = None
+        self._next_poll = 0
+        self._next_prune = 0
+
+    def trigger(self):
+        """Look for new expiries now, e.g. because accounts or tokens were changed."""
+        self._wakeup.set()
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds, or until trigger() is called."""
+        self._wakeup.wait(timeout)
+
+    def get_next_prune(self, now=None):
+        """Return when the next prune is due."""
+        now = time.time() if now is None else now
+        if self._wakeup.is_set() or now >= self._next_poll:
+            self._wakeup.clear()
+            with self.db.read_connection() as conn:
+                next_expiry = conn.get_next_expiry(after=self._last_prune)
+            self._next_prune = self._last_prune + self.recheck_interval
+            if next_expiry is not None:
+                self._next_prune = min(self._next_prune, next_expiry)
+            if self._retry_at is not None:
+                # after a failure, don't try again before retry_interval has passed
+                self._next_prune = self._retry_at
+            self._next_poll = now + self.poll_interval
+        return self._next_prune
+
+    def is_due(self, now=None):
+        now = time.time() if now is None else now
+        return now >= self.get_next_prune(now)
+
+    def prune(self):
+        """Prune expired accounts, within the time budget, and log the result.
+
+        If mailcow or the database fail, the prune is retried later.
+        """
+        try:
+            result = prune(self.db, max_seconds=self.max_seconds)
+        except (MailcowError, RequestException, sqlite3.OperationalError) as e:
+            logging.warning("prune failed, retrying in %d seconds: %s", self.retry_interval, e)
+            self._retry_at = int(time.time()) + self.retry_interval
+            self._next_poll = 0
+            return {"status": "error", "message": ["prune failed: {}".format(e)], "done": False}
+        for logmsg in result.get("message"):
+            logging.info("%s", logmsg)
+        # a resumed prune only deleted accounts which expired before it was started
+        self._last_prune = result["sysdate"]
+        if not result["done"]:
+            self._retry_at = 0
+        elif result["status"] == "error":
+            self._retry_at = int(time.time()) + self.retry_interval
+        else:
+            self._retry_at = None
+        self._next_poll = 0
+        return result
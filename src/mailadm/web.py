@@ -1,9 +1,9 @@
 from flask import Flask, jsonify, request
-from requests.exceptions import ReadTimeout
+from requests.exceptions import RequestException
 
 import mailadm.db
 from mailadm.conn import DBError
-from mailadm.mailcow import MailcowError
+from mailadm.mailcow import CircuitOpenError, MailcowError
 
 
 def create_app_from_db_path(db_path=None):
@@ -27,46 +27,52 @@ def create_app_from_db(db):
                 403,
             )
 
-        with db.write_transaction() as conn:
+        with db.read_connection() as conn:
             token_info = conn.get_tokeninfo_by_token(token)
-            if token_info is None:
+        if token_info is None:
+            return (
+                jsonify(
+                    type="error",
+                    status_code=403,
+                    reason="token {} is invalid".format(token),
+                ),
+                403,
+            )
+        try:
+            user_info = db.add_email_account_tries(token_info, tries=10)
+            return jsonify(
+                email=user_info.addr,
+                password=user_info.password,
+                expiry=token_info.expiry,
+                ttl=user_info.ttl,
+            )
+        except CircuitOpenError as e:
+            return (
+                jsonify(type="error", status_code=503, reason=str(e)),
+                503,
+                {"Retry-After": str(e.retry_after)},
+            )
+        except (DBError, MailcowError) as e:
+            if "does already exist" in str(e):
                 return (
                     jsonify(
                         type="error",
-                        status_code=403,
-                        reason="token {} is invalid".format(token),
+                        status_code=409,
+                        reason="user already exists in mailcow",
                     ),
-                    403,
+                    409,
                 )
-            try:
-                user_info = conn.add_email_account_tries(token_info, tries=10)
-                return jsonify(
-                    email=user_info.addr,
-                    password=user_info.password,
-                    expiry=token_info.expiry,
-                    ttl=user_info.ttl,
+            if "UNIQUE constraint failed" in str(e):
+                return (
+                    jsonify(
+                        type="error",
+                        status_code=409,
+                        reason="user already exists in mailadm",
+                    ),
+                    409,
                 )
-            except (DBError, MailcowError) as e:
-                if "does already exist" in str(e):
-                    return (
-                        jsonify(
-                            type="error",
-                            status_code=409,
-                            reason="user already exists in mailcow",
-                        ),
-                        409,
-                    )
-                if "UNIQUE constraint failed" in str(e):
-                    return (
-                        jsonify(
-                            type="error",
-                            status_code=409,
-                            reason="user already exists in mailadm",
-                        ),
-                        409,
-                    )
-                return jsonify(type="error", status_code=500, reason=str(e)), 500
-            except ReadTimeout:
-                return jsonify(type="error", status_code=504, reason="mailcow not reachable"), 504
+            return jsonify(type="error", status_code=500, reason=str(e)), 500
+        except RequestException:
+            return jsonify(type="error", status_code=504, reason="mailcow not reachable"), 504
 
     return app
@@ -0,0 +1,79 @@
+"""
+running bot commands on worker threads
+"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WorkerPool:
+    """Runs tasks on a bounded number of worker threads.
+
+    Tasks with the same key, e.g. the commands of one admin, run one after
+    another in the order they were submitted; tasks with different keys run
+    concurrently. At most ``max_pending`` tasks wait at a time. A task which
+    waited longer than ``timeout`` seconds is not run anymore; its
+    ``on_timeout`` callback is called instead.
+
+    ``timeout`` only limits how long a task waits in the queue: a running
+    thread can't be stopped, so tasks have to limit their own run time, as
+    the mailcow requests of bot commands do with their HTTP timeouts.
+
+    :param workers: how many tasks run at the same time
+    :param max_pending: how many tasks may wait before submit() refuses new ones
+    :param timeout: how many seconds a task may wait in the queue before it is dropped
+    """
+
+    def __init__(self, workers=4, max_pending=100, timeout=5 * 60):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mailadm")
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._pending = 0
+
+    def submit(self, key, task, on_timeout=None) -> bool:
+        """Queue task() after the other tasks of key; return False if too many tasks wait."""
+        item = (time.monotonic(), task, on_timeout)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                # a worker is already running the tasks of this key
+                queue.append(item)
+                return True
+            self._queues[key] = collections.deque([item])
+        self._executor.submit(self._run, key)
+        return True
+
+    def get_pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                submitted, task, on_timeout = queue.popleft()
+                self._pending -= 1
+            try:
+                waited = time.monotonic() - submitted
+                if waited <= self.timeout:
+                    task()
+                else:
+                    logging.warning("dropping a task of %r which waited %.1fs", key, waited)
+                    if on_timeout is not None:
+                        on_timeout()
+            except Exception:
+                logging.exception("task failed: %r", key)
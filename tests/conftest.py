@@ -1,14 +1,18 @@
 import collections
 import grp
+import json
 import os
 import pwd
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from random import randint
 
 import deltachat
 import mailadm.bot
 import mailadm.db
+import mailadm.mailcow
 import pytest
 from _pytest.pytester import LineMatcher
 
@@ -24,6 +28,12 @@ def _nocfg(monkeypatch):
     monkeypatch.setattr(pwd, "getpwnam", getpwnam)
 
 
+@pytest.fixture(autouse=True)
+def _circuit_breaker(monkeypatch):
+    # failed mailcow requests of one test must not open the breaker for the next ones
+    monkeypatch.setattr(mailadm.mailcow, "circuit_breaker", mailadm.mailcow.CircuitBreaker())
+
+
 class ClickRunner:
     def __init__(self, main):
         from click.testing import CliRunner
@@ -179,8 +189,73 @@ def mailcow(db):
         return conn.get_mailcow_connection()
 
 
+class FakeMailcow:
+    """A local HTTP server which answers mailcow API requests.
+
+    Set ``responses[path]`` to a function which gets the decoded JSON body (None
+    for GET requests) and returns the JSON answer, or a (status, JSON answer)
+    tuple; unknown paths answer ``{}``.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.answer(None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.answer(json.loads(self.rfile.read(length)))
+
+            def answer(self, payload):
+                path = self.path.split("/api/v1/", 1)[-1]
+                fake.requests.append((self.command, path, payload))
+                response = fake.responses.get(path, lambda payload: {})(payload)
+                status, response = response if isinstance(response, tuple) else (200, response)
+                body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:%d/api/v1/" % (self.server.server_address[1],)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_mailcow():
+    fake = FakeMailcow()
+    yield fake
+    fake.close()
+
+
 @pytest.fixture
 def make_db(monkeypatch, mailcow_auth, mailcow_endpoint, mailcow_domain):
+    mailcow_token = mailcow_auth.get("X-API-Key")
+    return _get_make_db(monkeypatch, mailcow_endpoint, mailcow_token, mailcow_domain)
+
+
+@pytest.fixture
+def make_fake_db(monkeypatch, fake_mailcow, mailcow_domain):
+    """Like make_db, but the databases use fake_mailcow, so no mailcow is needed."""
+    return _get_make_db(monkeypatch, fake_mailcow.endpoint, "fake-token", mailcow_domain)
+
+
+def _get_make_db(monkeypatch, mailcow_endpoint, mailcow_token, mailcow_domain):
     def make_db(basedir, init=True):
         basedir = Path(str(basedir))
         db_path = basedir.joinpath("mailadm.db")
@@ -190,7 +265,7 @@ def make_db(monkeypatch, mailcow_auth, mailcow_endpoint, mailcow_domain):
                 mail_domain=mailcow_domain,
                 web_endpoint="https://example.org/new_email",
                 mailcow_endpoint=mailcow_endpoint,
-                mailcow_token=mailcow_auth.get("X-API-Key"),
+                mailcow_token=mailcow_token,
             )
 
         # re-route all queries for sysfiles to the tmpdir
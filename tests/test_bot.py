@@ -44,6 +44,16 @@ class TestAdminGroup:
             time.sleep(0.1)
         assert direct.get_messages()[-1].text == "Sorry, I only take commands from the admin group."
 
+    def test_admins_follow_admin_group(self, admingroup):
+        botplugin = admingroup.botplugin
+        admin_addr = admingroup.botadmin.get_config("addr")
+        assert admin_addr in [contact.addr for contact in botplugin.admins.values()]
+        botplugin.admingroup.remove_contact(admingroup.admbot.get_contact_by_addr(admin_addr))
+        while admin_addr in [contact.addr for contact in botplugin.admins.values()]:
+            time.sleep(0.1)
+        botplugin.refresh_admins()
+        assert len(botplugin.admins) == 1
+
 
 @pytest.mark.timeout(TIMEOUT * 2)
 class TestSupportGroup:
@@ -155,9 +165,30 @@ class TestSupportGroup:
         print(bot.get_self_contact().addr)
 
         assert admingroup.botplugin.is_support_group(supportgroup)
-        assert not admingroup.botplugin.is_support_group(admingroup)
+        assert not admingroup.botplugin.is_support_group(admingroup.botplugin.admingroup)
         assert not admingroup.botplugin.is_support_group(supportchat_bot_side)
 
+    def test_support_group_deleted(self, admingroup, supportuser):
+        bot = admingroup.admbot
+        support_group_name = supportuser.get_config("addr") + " support group"
+
+        def wait_for_support_group():
+            while 1:
+                for chat in bot.get_chats():
+                    if chat.get_name() == support_group_name:
+                        return chat
+                time.sleep(0.1)
+
+        supportchat = supportuser.create_chat(bot.get_config("addr"))
+        supportchat.send_text("Can I ask you a support question?")
+        supportgroup = wait_for_support_group()
+        supportgroup.delete()
+        supportchat.send_text("Hello?")
+        new_supportgroup = wait_for_support_group()
+        assert new_supportgroup.id != supportgroup.id
+        with admingroup.botplugin.db.read_connection() as conn:
+            assert conn.get_support_group_id(supportuser.get_config("addr")) == new_supportgroup.id
+
     def test_support_user_help(self, admingroup, supportuser):
         supchat = supportuser.create_chat(admingroup.admbot.get_config("addr"))
         supchat.send_text("/help")
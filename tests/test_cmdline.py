@@ -1,5 +1,7 @@
 import datetime
+import json
 import os
+import sys
 import time
 from random import randint
 
@@ -9,12 +11,23 @@ from mailadm.mailcow import MailcowError
 
 @pytest.fixture
 def mycmd(cmd, make_db, tmpdir, monkeypatch, mailcow_domain, mailcow_endpoint):
+    if not os.environ["MAILCOW_TOKEN"]:
+        raise KeyError("Please set mailcow API Key with the environment variable MAILCOW_TOKEN")
+    return init_cmd(cmd, make_db, tmpdir, monkeypatch, mailcow_domain, mailcow_endpoint)
+
+
+@pytest.fixture
+def fakecmd(cmd, make_fake_db, fake_mailcow, tmpdir, monkeypatch, mailcow_domain):
+    """Like mycmd, but mailadm talks to fake_mailcow."""
+    monkeypatch.setenv("MAILCOW_TOKEN", "fake-token")
+    return init_cmd(cmd, make_fake_db, tmpdir, monkeypatch, mailcow_domain, fake_mailcow.endpoint)
+
+
+def init_cmd(cmd, make_db, tmpdir, monkeypatch, mailcow_domain, mailcow_endpoint):
     db = make_db(tmpdir.mkdir("mycmd"), init=False)
     monkeypatch.setenv("MAILADM_DB", str(db.path))
     monkeypatch.setenv("ADMBOT_DB", str(tmpdir.mkdir("admbot")) + "admbot.db")
     cmd.db = db
-    if not os.environ["MAILCOW_TOKEN"]:
-        raise KeyError("Please set mailcow API Key with the environment variable MAILCOW_TOKEN")
     cmd.run_ok(
         [
             "init",
@@ -224,6 +237,23 @@ class TestUsers:
         """,
         )
 
+    def test_adduser_dryrun(self, fakecmd, fake_mailcow, mailcow_domain):
+        def delete(addrs):
+            # this would time out if the dry run held the write lock
+            with fakecmd.db.write_transaction():
+                pass
+            return [{"type": "success", "msg": ["mailbox_removed", addr]} for addr in addrs]
+
+        fake_mailcow.responses["add/mailbox"] = lambda payload: [{"type": "success"}]
+        fake_mailcow.responses["delete/mailbox"] = delete
+        fakecmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix", "tmp."])
+        fakecmd.run_ok(["add-user", "tmp.1@" + mailcow_domain, "--dryrun"], "*Would create tmp.1@*")
+        paths = [path for _, path, _ in fake_mailcow.requests]
+        assert paths[-2:] == ["add/mailbox", "delete/mailbox"]
+        with fakecmd.db.read_connection() as conn:
+            assert conn.get_user_list() == []
+            assert conn.get_tokeninfo_by_name("test1").usecount == 0
+
     def test_adduser_and_expire(self, mycmd, monkeypatch, mailcow_domain):
         mycmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix", "pytest."])
         addr = "pytest.%s@%s" % (randint(0, 49999), mailcow_domain)
@@ -282,6 +312,81 @@ class TestUsers:
         mycmd.run_ok(["del-user", addr])
         mycmd.run_ok(["del-user", addr2])
 
+    def test_prune_batches(self, fakecmd, fake_mailcow):
+        def delete(addrs):
+            return [
+                (
+                    {"type": "success", "msg": ["x", addr]}
+                    if addr[4] not in "13"
+                    else {"type": "danger", "msg": "access_denied"}
+                )
+                for addr in addrs
+            ]
+
+        fake_mailcow.responses["delete/mailbox"] = delete
+        # tmp.1 was deleted in mailcow already, tmp.3 can't be deleted
+        fake_mailcow.responses["get/mailbox/tmp.3%40example.org"] = lambda payload: {
+            "username": "tmp.3@example.org",
+        }
+        fakecmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix=tmp."])
+        with fakecmd.db.write_transaction() as conn:
+            for i in range(5):
+                conn.add_user_db("tmp.%d@example.org" % (i,), date=1000, ttl=60, token_name="test1")
+        fakecmd.run_fail(
+            ["prune", "--batch-size=2"],
+            "*failed to delete account tmp.3@example.org*",
+        )
+        deletes = [
+            payload for _, path, payload in fake_mailcow.requests if path == "delete/mailbox"
+        ]
+        assert [len(payload) for payload in deletes] == [2, 2, 1]
+        with fakecmd.db.read_connection() as conn:
+            assert conn.execute("SELECT addr FROM users").fetchall() == [("tmp.3@example.org",)]
+
+    def test_prune_lists_mailboxes_once(self, fakecmd, fake_mailcow):
+        addrs = ["tmp.%03d@example.org" % (i,) for i in range(250)]
+        fake_mailcow.responses["get/mailbox/all"] = lambda payload: [
+            {"username": addr, "quota": 0, "last_imap_login": 0} for addr in addrs
+        ]
+        fake_mailcow.responses["delete/mailbox"] = lambda addrs: [
+            {"type": "success", "msg": ["x", addr]} for addr in addrs
+        ]
+        fakecmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix=tmp.", "--maxuse=250"])
+        with fakecmd.db.write_transaction() as conn:
+            for addr in addrs:
+                conn.add_user_db(addr, date=1000, ttl=30 * 24 * 60 * 60, token_name="test1")
+        fakecmd.run_ok(["prune", "--batch-size=100"], "*checked 250 and pruned 250 accounts*")
+        paths = [path for _, path, _ in fake_mailcow.requests]
+        assert paths == ["get/mailbox/all"] + ["delete/mailbox"] * 3
+
+    def test_prune_resumes(self, fakecmd, fake_mailcow):
+        fake_mailcow.responses["delete/mailbox"] = lambda addrs: [
+            {"type": "success", "msg": ["x", addr]} for addr in addrs
+        ]
+        fakecmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix=tmp."])
+        with fakecmd.db.write_transaction() as conn:
+            for i in range(5):
+                conn.add_user_db("tmp.%d@example.org" % (i,), date=1000, ttl=60, token_name="test1")
+        fakecmd.run_ok(
+            ["prune", "--batch-size=2", "--max-accounts=3"],
+            "*checked 3 and pruned 3 accounts*to be continued*",
+        )
+        with fakecmd.db.read_connection() as conn:
+            sysdate, addr = conn.get_prune_checkpoint()
+            assert addr == "tmp.2@example.org"
+        fakecmd.run_ok(
+            ["prune"],
+            """
+            *resuming prune after tmp.2@example.org*
+            *checked 2 and pruned 2*
+        """,
+        )
+        assert [len(payload) for _, _, payload in fake_mailcow.requests] == [2, 1, 2]
+        with fakecmd.db.read_connection() as conn:
+            assert conn.get_prune_checkpoint() is None
+            assert conn.execute("SELECT count(*) FROM users").fetchone()[0] == 0
+        fakecmd.run_ok(["prune"], "*nothing to prune*")
+
 
 class TestSetupBot:
     def test_account_already_exists(self, mycmd, mailcow, mailcow_domain):
@@ -324,3 +429,55 @@ class TestSetupBot:
             *Cannot login as "bot@testrun.org". Please check if the email address and the password*
         """,
         )
+
+
+class TestExportImport:
+    def test_export_import(self, fakecmd, make_fake_db, tmpdir, monkeypatch):
+        fakecmd.run_ok(["add-token", "test1", "--expiry=1d", "--prefix=tmpy.", "--maxuse=7"])
+        fakecmd.run_ok(["add-token", "test2", "--expiry=never", "--prefix=tmpx."])
+        with fakecmd.db.write_transaction() as conn:
+            conn.add_user_db("tmpy.a@example.org", date=1000, ttl=60, token_name="test1")
+            conn.add_user_db("tmpx.b@example.org", date=1000, ttl=sys.maxsize, token_name="test2")
+        dump = tmpdir.join("dump.ndjson")
+        fakecmd.run_ok(["export", dump.strpath], "*exported 2 tokens and 2 users*")
+        lines = dump.read().splitlines()
+        assert len(lines) == 4
+        assert json.loads(lines[0])["type"] == "token"
+
+        db2 = make_fake_db(tmpdir.mkdir("import"), init=False)
+        monkeypatch.setenv("MAILADM_DB", str(db2.path))
+        fakecmd.run_ok(["init", "--mailcow-endpoint", "x", "--mailcow-token", "x"])
+        fakecmd.run_ok(
+            ["import", "--skip-mailcow", "--batch-size=1", dump.strpath],
+            "*imported 2 tokens and 2 users*",
+        )
+        fakecmd.run_fail(["import", "--skip-mailcow", dump.strpath], "*UNIQUE constraint failed*")
+        with db2.read_connection() as conn:
+            token_info = conn.get_tokeninfo_by_name("test1")
+            assert (token_info.maxuse, token_info.usecount) == (7, 1)
+            q = "SELECT addr, expires_at FROM users ORDER BY addr"
+            assert conn.execute(q).fetchall() == [
+                ("tmpx.b@example.org", None),
+                ("tmpy.a@example.org", 1060),
+            ]
+
+    def test_import_invalid(self, fakecmd, tmpdir):
+        dump = tmpdir.join("dump.ndjson")
+        dump.write('{"type": "token", "name": "x"}\n')
+        fakecmd.run_fail(["import", "--skip-mailcow", dump.strpath], "*line 1: invalid record*")
+
+
+class TestTopQueries:
+    def test_top_queries(self, fakecmd):
+        fakecmd.run_ok(["list-tokens"])
+        fakecmd.run_ok(
+            ["top-queries"],
+            """
+            *Top queries*
+            *calls*total*
+            *Write lock and connections per process*
+            *writers waited*ms in total*
+            *connections:*opened*reused*
+        """,
+        )
+        fakecmd.run_ok(["top-queries", "--reset"], "*reset*")
@@ -1,5 +1,15 @@
+import gc
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import mailadm.db
 import pytest
-from mailadm.conn import DBError, TokenExhaustedError, UserNotFoundError
+from mailadm.conn import Connection, DBError, TokenExhaustedError, UserNotFoundError
+from mailadm.mailcow import MailcowError
 from mailadm.util import gen_password
 
 
@@ -26,6 +36,8 @@ def test_token(tmpdir, make_db):
         assert conn.get_token_list()
         conn.del_token(name="pytest:1w")
         assert not conn.get_token_list()
+        with pytest.raises(ValueError):
+            conn.mod_token(name="pytest:1w", maxuse=3)
 
 
 class TestTokenAccounts:
@@ -61,6 +73,16 @@ class TestTokenAccounts:
         token_info = conn.get_tokeninfo_by_name("pytest:1h")
         with pytest.raises(TokenExhaustedError):
             conn.add_email_account(token_info, addr="tmp.xx@" + mailcow_domain, password=password)
+        with pytest.raises(TokenExhaustedError):
+            conn.add_user_db(
+                addr="tmp.xx@" + mailcow_domain,
+                date=now,
+                ttl=60,
+                token_name="pytest:1h",
+            )
+        assert conn.get_tokeninfo_by_name("pytest:1h").usecount == self.MAXUSE
+        q = "SELECT count(*) FROM users WHERE addr=?"
+        assert conn.fetchone(q, ("tmp.xx@" + mailcow_domain,))[0] == 0
 
     def test_add_expire_del(self, conn, mailcow_domain):
         now = 10000
@@ -87,3 +109,499 @@ class TestTokenAccounts:
         with pytest.raises(UserNotFoundError):
             conn.del_user_db(addr2)
         assert conn.get_tokeninfo_by_name("pytest:1h").usecount == 3
+
+
+def test_connection_pool_reuse(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.read_connection() as conn:
+        sqlconn = conn._sqlconn
+    opened = db.get_pool_stats()["opened"]
+    for _ in range(3):
+        with db.read_connection() as conn:
+            assert conn._sqlconn is sqlconn
+            assert conn.is_initialized()
+    stats = db.get_pool_stats()
+    assert stats["opened"] == opened
+    assert stats["reused"] >= 3
+    assert stats["idle_readers"] == 1
+
+    db.close()
+    assert db.get_pool_stats()["idle_readers"] == 0
+
+
+def test_connection_pool_discards_uncommitted(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_connection() as conn:
+        conn.add_token(name="pytest:1w", prefix="xyz", expiry="1w", maxuse=5, token="1234567890")
+    with db.write_connection() as conn:
+        assert not conn.get_token_list()
+
+
+def test_connection_pool_resets_pragmas(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1w", prefix="xyz", expiry="1w", maxuse=5, token="1234567890")
+    with db.write_connection() as conn:
+        conn.add_user_db("xyz.1@example.org", date=1000, ttl=3600, token_name="pytest:1w")
+        conn.commit()
+    with db.write_transaction() as conn:
+        assert conn.fetchone("PRAGMA foreign_keys")[0] == 0
+        conn.del_token("pytest:1w")
+
+
+def test_connection_pool_fork(tmpdir, monkeypatch):
+    freed = []
+
+    class Connection(mailadm.db.PooledConnection):
+        def __del__(self):
+            freed.append(id(self))
+
+    monkeypatch.setattr(mailadm.db, "PooledConnection", Connection)
+    pool = mailadm.db.ConnectionPool(Path(tmpdir.join("pool.db").strpath))
+    parent_ids = []
+    opened = threading.Event()
+    done = threading.Event()
+
+    def use_connection():
+        sqlconn = pool.acquire(write=True)
+        parent_ids.append(id(sqlconn))
+        pool.release(sqlconn, write=True)
+        opened.set()
+        done.wait(10)
+
+    thread = threading.Thread(target=use_connection)
+    thread.start()
+    assert opened.wait(10)
+    sqlconn = pool.acquire(write=False)
+    parent_ids.append(id(sqlconn))
+    pool.release(sqlconn, write=False)
+    del sqlconn
+
+    pid = os.fork()
+    if pid == 0:
+        # the child must neither reuse nor close the connections of its parent
+        code = 1
+        try:
+            sqlconn = pool.acquire(write=False)
+            gc.collect()
+            if id(sqlconn) not in parent_ids and not freed:
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    done.set()
+    thread.join()
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_config_cache(tmpdir, make_db):
+    db = make_db(tmpdir)
+    config = db.get_config()
+    loads = db.config_cache.loads
+    for _ in range(3):
+        with db.read_connection() as conn:
+            assert conn.config is config
+            assert conn.get_tokeninfo_by_name("notexisting") is None
+    assert db.config_cache.loads == loads
+
+    # another process changes the config
+    other = mailadm.db.DB(db.path)
+    with other.write_transaction() as conn:
+        conn.set_config("web_endpoint", "https://example.org/other")
+        assert conn.config.web_endpoint == "https://example.org/other"
+    assert db.get_config().web_endpoint == "https://example.org/other"
+    assert db.config_cache.loads == loads + 1
+
+
+def test_config_cache_rollback(tmpdir, make_db):
+    db = make_db(tmpdir)
+    web_endpoint = db.get_config().web_endpoint
+
+    def set_web_endpoint_and_fail():
+        with db.write_transaction() as conn:
+            conn.set_config("web_endpoint", "https://example.org/other")
+            assert conn.config.web_endpoint == "https://example.org/other"
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        set_web_endpoint_and_fail()
+    assert db.get_config().web_endpoint == web_endpoint
+
+
+def test_expired_users_use_index(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.add_token(name="pytest:never", prefix="abc", expiry="never", token="0987654321")
+        conn.add_user_db(addr="xyz.1@example.org", date=1000, ttl=3600, token_name="pytest:1h")
+        conn.add_user_db(
+            addr="abc.1@example.org",
+            date=1000,
+            ttl=sys.maxsize,
+            token_name="pytest:never",
+        )
+        assert [u.addr for u in conn.get_expired_users(sysdate=sys.maxsize)] == [
+            "xyz.1@example.org",
+        ]
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT addr FROM users WHERE expires_at < 5")
+        assert "users_expires_at" in str(plan.fetchall())
+
+
+def test_migrate_expires_at(tmpdir):
+    path = Path(str(tmpdir)).joinpath("mailadm.db")
+    sqlconn = sqlite3.connect(str(path))
+    sqlconn.executescript(
+        """
+        CREATE TABLE tokens (name TEXT PRIMARY KEY, token TEXT NOT NULL UNIQUE,
+            expiry TEXT NOT NULL, prefix TEXT, maxuse INTEGER default 50,
+            usecount INTEGER default 0);
+        CREATE TABLE users (addr TEXT PRIMARY KEY, date INTEGER, ttl INTEGER,
+            token_name TEXT NOT NULL, FOREIGN KEY (token_name) REFERENCES tokens (name));
+        CREATE TABLE config (name TEXT PRIMARY KEY, value TEXT);
+        INSERT INTO config VALUES ('dbversion', '1');
+        INSERT INTO tokens (name, token, expiry, prefix) VALUES ('t', '123', '1h', 'tmp.');
+        """,
+    )
+    sqlconn.execute("INSERT INTO users VALUES ('tmp.a@example.org', 1000, 3600, 't')")
+    sqlconn.execute("INSERT INTO users VALUES ('tmp.b@example.org', 1000, ?, 't')", (sys.maxsize,))
+    sqlconn.commit()
+    sqlconn.close()
+
+    db = mailadm.db.DB(path)
+    with db.read_connection() as conn:
+        assert conn.get_dbversion() == db.CURRENT_DBVERSION
+        q = "SELECT addr, expires_at FROM users ORDER BY addr"
+        assert conn.execute(q).fetchall() == [
+            ("tmp.a@example.org", 4600),
+            ("tmp.b@example.org", None),
+        ]
+
+
+def test_tokeninfo_by_addr_longest_prefix(tmpdir, make_db, mailcow_domain):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="all", prefix="", expiry="1w", token="1111111111")
+        conn.add_token(name="tmp", prefix="tmp.", expiry="1w", token="2222222222")
+        assert conn.get_tokeninfo_by_addr("tmp.conf.x@" + mailcow_domain).name == "tmp"
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_addr("x@" + mailcow_domain).name == "all"
+        assert conn.get_tokeninfo_by_addr("tmp.x@" + mailcow_domain).name == "tmp"
+    builds = db.token_index.loads
+
+    # another process adds a more specific token
+    other = mailadm.db.DB(db.path)
+    with other.write_transaction() as conn:
+        conn.add_token(name="conf", prefix="tmp.conf.", expiry="1w", token="3333333333")
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_addr("tmp.conf.x@" + mailcow_domain).name == "conf"
+        assert conn.get_tokeninfo_by_addr("tmp.x@" + mailcow_domain).name == "tmp"
+    assert db.token_index.loads == builds + 1
+
+    with db.write_transaction() as conn:
+        conn.del_token("all")
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_addr("x@" + mailcow_domain) is None
+
+
+def test_reserve_token_concurrently(tmpdir, make_db):
+    maxuse = 5
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", maxuse=maxuse, token="12345")
+
+    reserved = []
+
+    def reserve():
+        for _ in range(5):
+            with db.write_connection() as conn:
+                try:
+                    conn.reserve_token("pytest:1h")
+                except TokenExhaustedError:
+                    continue
+                conn.commit()
+                reserved.append(1)
+
+    threads = [threading.Thread(target=reserve) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(reserved) == maxuse
+    with db.write_transaction() as conn:
+        assert conn.get_tokeninfo_by_name("pytest:1h").usecount == maxuse
+        conn.release_token("pytest:1h")
+        assert conn.get_tokeninfo_by_name("pytest:1h").usecount == maxuse - 1
+
+
+def test_writer_queue_deadline(tmpdir, make_db):
+    db = make_db(tmpdir)
+    db.writers.deadline = 0.2
+    writing = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with db.write_transaction():
+            writing.set()
+            done.wait()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    writing.wait()
+    with pytest.raises(sqlite3.OperationalError):
+        db.write_transaction().__enter__()
+    done.set()
+    thread.join()
+    stats = db.get_lock_stats()
+    assert stats["timeouts"] == 1
+    assert stats["waiting"] == 0
+
+    with db.write_transaction() as conn:
+        assert conn.lock_wait < 0.2
+
+
+def test_writer_backoff_other_process(tmpdir, make_db):
+    db = make_db(tmpdir)
+    other = mailadm.db.DB(db.path)
+    writing = threading.Event()
+
+    def write():
+        with other.write_transaction():
+            writing.set()
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    writing.wait()
+    with db.write_transaction() as conn:
+        assert conn.lock_wait >= 0.2
+    thread.join()
+    assert db.get_lock_stats()["wait_max"] >= 0.2
+
+
+def test_migrations_registry():
+    versions = [version for version, _migration in mailadm.db.DB.MIGRATIONS]
+    assert versions == sorted(versions)
+    assert versions[-1] == mailadm.db.DB.CURRENT_DBVERSION
+
+
+def test_newer_dbversion(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.set_config("dbversion", db.CURRENT_DBVERSION + 1)
+    with pytest.raises(DBError):
+        mailadm.db.DB(db.path)
+
+
+def test_rebuild_users_table(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.add_user_db(addr="xyz.1@example.org", date=1000, ttl=3600, token_name="pytest:1h")
+        # simulate a users table from an old mailadm version
+        conn.execute("ALTER TABLE users ADD COLUMN homedir TEXT")
+        conn.execute("UPDATE users SET expires_at = NULL")
+    with db.write_transaction() as conn:
+        mailadm.db.rebuild_users_table(conn)
+    with db.read_connection() as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        assert columns == ["addr", "date", "ttl", "token_name", "expires_at"]
+        assert conn.execute("SELECT addr, expires_at FROM users").fetchall() == [
+            ("xyz.1@example.org", 4600),
+        ]
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT addr FROM users WHERE expires_at < 5")
+        assert "users_expires_at" in str(plan.fetchall())
+
+
+def test_query_profiler_labels(tmpdir, make_fake_db):
+    db = make_fake_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.add_user_db(addr="xyz.1@example.org", date=1000, ttl=3600, token_name="pytest:1h")
+        conn.add_user_db(addr="xyz.2@example.org", date=1000, ttl=3600, token_name="pytest:1h")
+    with db.read_connection() as conn:
+        conn.get_expired_users(sysdate=5000)
+        assert len(conn.get_user_list(token="pytest:1h")) == 2
+        conn.read_token_prefixes()
+    labels = {entry["label"]: entry for entry in db.profiler.get_entries()}
+    assert labels["get_expired_users"]["rows"] == 2
+    # the rows of streamed SELECTs are counted while they are fetched
+    assert labels["iter_user_list"]["rows"] == 2
+    assert labels["read_token_prefixes"]["rows"] == labels["read_token_prefixes"]["calls"]
+    assert labels["get_tokeninfo_by_name"]["calls"] >= 1
+    assert labels["add_user_db"]["calls"] >= 1
+
+
+def test_mailbox_mirror(tmpdir, make_fake_db, fake_mailcow, mailcow_domain):
+    xyz1, xyz2, admin = ["%s@%s" % (name, mailcow_domain) for name in ("xyz.1", "xyz.2", "admin")]
+    mailboxes = [
+        {"username": xyz1, "last_imap_login": 500, "tags": ["mailadm:pytest:1h"]},
+        {"username": admin, "last_imap_login": 0, "tags": []},
+    ]
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: mailboxes
+    db = make_fake_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.execute("INSERT INTO mailboxes (addr, seen) VALUES ('gone@example.org', 0)")
+        assert not conn.mailboxes_fresh()
+
+    assert db.refresh_mailboxes(batch_size=1) == (2, 1)
+    requests = len(fake_mailcow.requests)
+    with db.read_connection() as conn:
+        assert conn.mailboxes_fresh()
+        assert [u.addr for u in conn.iter_mailcow_users()] == [xyz1, admin]
+        user = conn.get_mailcow_user(xyz1)
+        assert (user.last_login, user.token) == (500, "pytest:1h")
+        assert conn.get_mailcow_user("gone@example.org") is None
+        token_info = conn.get_tokeninfo_by_name("pytest:1h")
+
+    # mailadm's own changes are written through, mailcow is only asked to create
+    fake_mailcow.responses["add/mailbox"] = lambda payload: [{"type": "success"}]
+    user_info = db.add_email_account(token_info, addr=xyz2)
+    with pytest.raises(MailcowError):
+        db.add_email_account(token_info, addr=admin)
+    assert [path for _, path, _ in fake_mailcow.requests[requests:]] == ["add/mailbox"]
+    with db.write_transaction() as conn:
+        assert conn.get_mailcow_user(user_info.addr).token == "pytest:1h"
+        assert [u.addr for u in conn.get_user_list()] == [admin, xyz1, xyz2]
+        conn.del_users_db([user_info.addr])
+        conn.del_mailboxes_db([user_info.addr])
+        assert conn.get_mailcow_user(user_info.addr) is None
+
+    # a stale mirror isn't used
+    db.mailbox_max_age = 0
+    with db.read_connection() as conn:
+        time.sleep(1.1)
+        assert not conn.mailboxes_fresh()
+        assert conn.get_mailcow_user(xyz1) is None
+    assert fake_mailcow.requests[-1][1] == "get/mailbox/xyz.1%40" + mailcow_domain
+
+
+def test_pending_accounts(tmpdir, make_fake_db, fake_mailcow, mailcow_domain, monkeypatch):
+    xyz1, xyz2, xyz3 = ["xyz.%d@%s" % (i, mailcow_domain) for i in (1, 2, 3)]
+    fake_mailcow.responses["add/mailbox"] = lambda payload: [{"type": "success"}]
+    fake_mailcow.responses["get/mailbox/" + xyz1.replace("@", "%40")] = lambda payload: {
+        "username": xyz1,
+    }
+    db = make_fake_db(tmpdir)
+    with db.write_transaction() as conn:
+        token_info = conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="123456")
+
+    def die(mailcow, user_info, check_exists=True):
+        # the process dies before it can confirm or cancel the account;
+        # mailcow created the mailbox of xyz.1 already, but not the one of xyz.2
+        raise KeyboardInterrupt()
+
+    with monkeypatch.context() as m:
+        m.setattr(mailadm.db, "add_mailcow_account", die)
+        for addr in (xyz1, xyz2):
+            with pytest.raises(KeyboardInterrupt):
+                db.add_email_account(token_info, addr=addr)
+    db.add_email_account(token_info, addr=xyz3)
+
+    now = int(time.time())
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("pytest:1h").usecount == 3
+        assert [u.addr for u in conn.get_pending_accounts(before=now + 1)] == [xyz1, xyz2]
+        # pending accounts are not pruned, they may not be in mailcow yet
+        assert [u.addr for u in conn.get_overdue_users(now + 7200)] == [xyz3]
+        assert [u.addr for u in conn.get_expired_users(now + 7200)] == [xyz3]
+
+    # the process which creates them may still be waiting for mailcow
+    assert db.finish_pending_accounts() == ([], [])
+    confirmed, cancelled = db.finish_pending_accounts(max_age=-1)
+    assert [u.addr for u in confirmed] == [xyz1]
+    assert [u.addr for u in cancelled] == [xyz2]
+    with db.read_connection() as conn:
+        assert conn.get_pending_accounts(before=now + 1) == []
+        assert [u.addr for u in conn.get_user_list()] == [xyz1, xyz3]
+        assert conn.get_tokeninfo_by_name("pytest:1h").usecount == 2
+
+
+@pytest.mark.parametrize("count", [3, 30])
+def test_expired_users_last_logins(tmpdir, make_fake_db, fake_mailcow, count):
+    sysdate = 100 * 24 * 60 * 60
+    mailboxes = {}
+    db = make_fake_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:30d", prefix="xyz", expiry="30d", token="1234567890")
+        ttl = conn.get_tokeninfo_by_name("pytest:30d").get_expiry_seconds()
+        for i in range(count):
+            addr = "xyz.%d@example.org" % (i,)
+            conn.add_user_db(addr=addr, date=0, ttl=ttl, token_name="pytest:30d")
+            # every second user was online recently
+            last_login = sysdate - 60 if i % 2 else 0
+            mailboxes[addr] = {"username": addr, "last_imap_login": last_login}
+    del mailboxes["xyz.0@example.org"]
+
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: list(mailboxes.values())
+    for addr, mailbox in mailboxes.items():
+        fake_mailcow.responses["get/mailbox/" + addr.replace("@", "%40")] = (
+            lambda payload, mailbox=mailbox: mailbox
+        )
+    with db.read_connection() as conn:
+        expired = conn.get_expired_users(sysdate)
+    assert [u.addr for u in expired] == ["xyz.%d@example.org" % (i,) for i in range(2, count, 2)]
+    paths = [path for _, path, _ in fake_mailcow.requests]
+    if count > Connection.MAILBOX_LOOKUP_MAX:
+        assert paths == ["get/mailbox/all"]
+    else:
+        assert sorted(paths) == ["get/mailbox/xyz.%d%%40example.org" % (i,) for i in range(count)]
+
+
+def test_iter_user_list_pages(tmpdir, make_fake_db, fake_mailcow):
+    addrs = ["tmp.%d@example.org" % (i,) for i in range(10)]
+    mailboxes = [{"username": addr} for addr in addrs[1:] + ["admin@example.org"]]
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: mailboxes
+    db = make_fake_db(tmpdir)
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="tmp.", expiry="1h", token="1234567890")
+        for addr in reversed(addrs):
+            conn.add_user_db(addr=addr, date=1000, ttl=3600, token_name="pytest:1h")
+
+    pages = []
+    after = ""
+    with db.read_connection() as conn:
+        while True:
+            page = list(conn.iter_user_list(after=after, limit=4))
+            if not page:
+                break
+            pages.append([(user.addr, user.token_name) for user in page])
+            after = page[-1].addr
+    assert [len(page) for page in pages] == [4, 4, 3]
+    users = [user for page in pages for user in page]
+    assert users[0] == ("admin@example.org", "created in mailcow")
+    assert users[1] == ("tmp.0@example.org", "WARNING: does not exist in mailcow")
+    assert users[2:] == [(addr, "pytest:1h") for addr in addrs[1:]]
+    with db.read_connection() as conn:
+        assert len(conn.get_user_list(token="pytest:1h")) == 10
+
+
+def test_support_groups(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        assert conn.get_support_group_id("user@example.org") is None
+        conn.set_support_group_id("user@example.org", 12)
+        conn.set_support_group_id("other@example.org", 13)
+        conn.set_support_group_id("user@example.org", 14)
+    with db.read_connection() as conn:
+        assert conn.get_support_group_id("user@example.org") == 14
+        assert conn.get_support_groups() == {"user@example.org": 14, "other@example.org": 13}
+    with db.write_transaction() as conn:
+        conn.set_support_groups({"new@example.org": 15})
+    with db.read_connection() as conn:
+        assert conn.get_support_groups() == {"new@example.org": 15}
+    with db.write_transaction() as conn:
+        conn.del_support_group("new@example.org")
+        assert conn.get_support_group_id("new@example.org") is None
+
+
+def test_chat_roles(tmpdir, make_db):
+    db = make_db(tmpdir)
+    with db.write_transaction() as conn:
+        assert conn.get_chat_roles() == {}
+        conn.set_chat_role(12, "support")
+        conn.set_chat_role(13, "foreign")
+        conn.set_chat_role(12, "foreign")
+    with db.read_connection() as conn:
+        assert conn.get_chat_roles() == {12: "foreign", 13: "foreign"}
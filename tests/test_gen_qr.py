@@ -1,4 +1,8 @@
-from mailadm.gen_qr import gen_qr
+import io
+import os
+
+from mailadm.gen_qr import QRCache, gen_qr
+from PIL import Image
 from pyzbar.pyzbar import decode
 
 
@@ -10,3 +14,25 @@ def test_gen_qr(db):
     image = gen_qr(config=config, token_info=token)
     qr_decoded = decode(image)[0]
     assert bytes(token.get_qr_uri(), encoding="ascii") == qr_decoded.data
+
+
+def test_qr_cache(db):
+    with db.write_transaction() as conn:
+        config = conn.config
+        token = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="pp")
+
+    cache = QRCache(directory=db.qr_cache.directory)
+    png = cache.get_png(config, token)
+    assert decode(Image.open(io.BytesIO(png)))[0].data == token.get_qr_uri().encode("ascii")
+    assert cache.get_png(config, token) == png
+    path = cache.get_path(config, token)
+    assert open(path, "rb").read() == png
+    assert cache.renders == 1
+
+    # another process finds the file
+    assert QRCache(directory=db.qr_cache.directory).get_png(config, token) == png
+
+    with db.write_transaction() as conn:
+        token = conn.mod_token("burner1", prefix="qq")
+    assert not os.path.exists(path)
+    assert db.qr_cache.get_png(config, token) != png
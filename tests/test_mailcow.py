@@ -1,7 +1,18 @@
+import json
+import time
 from random import randint
 
 import pytest
-from mailadm.mailcow import MailcowError
+import requests
+from mailadm.mailcow import (
+    HTTP_TIMEOUT,
+    CircuitBreaker,
+    CircuitOpenError,
+    MailcowConnection,
+    MailcowError,
+    SharedSession,
+    iter_json_list,
+)
 
 
 class TestMailcow:
@@ -30,3 +41,197 @@ class TestMailcow:
             mailcow.get_user(addr)
         with pytest.raises(MailcowError):
             mailcow.del_user_mailcow(addr)
+
+
+def test_shared_session_reuses_connections(fake_mailcow):
+    shared = SharedSession()
+    for _ in range(3):
+        mailcow = MailcowConnection(fake_mailcow.endpoint, "token", session=shared.get())
+        assert mailcow.get_user("user1@example.org") is None
+    assert shared.get_stats() == {
+        "requests": 3,
+        "connections_opened": 1,
+        "connections_reused": 2,
+    }
+
+
+def test_del_users_mailcow(fake_mailcow):
+    def delete(addrs):
+        return [
+            {"type": "success", "msg": ["mailbox_removed", addrs[0]]},
+            {"type": "danger", "msg": ["access_denied", addrs[1]]},
+            {"type": "success", "msg": ["mailbox_removed", addrs[2]]},
+        ]
+
+    fake_mailcow.responses["delete/mailbox"] = delete
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token")
+    addrs = ["user%d@example.org" % (i,) for i in range(3)]
+    for addr in addrs:
+        fake_mailcow.responses["get/mailbox/" + addr.replace("@", "%40")] = (
+            lambda payload, addr=addr: {"username": addr}
+        )
+    errors = mailcow.del_users_mailcow(addrs)
+    assert list(errors) == ["user1@example.org"]
+    assert isinstance(errors["user1@example.org"], MailcowError)
+    assert fake_mailcow.requests == [
+        ("POST", "delete/mailbox", addrs),
+        ("GET", "get/mailbox/user1%40example.org", None),
+    ]
+
+    fake_mailcow.responses["delete/mailbox"] = lambda addrs: [{"type": "danger", "msg": "x"}]
+    assert set(mailcow.del_users_mailcow(addrs)) == set(addrs)
+    assert mailcow.del_users_mailcow([]) == {}
+
+
+def test_del_users_mailcow_missing(fake_mailcow):
+    # mailcow answers like this for addresses which have no mailbox
+    fake_mailcow.responses["delete/mailbox"] = lambda addrs: [
+        {"type": "danger", "msg": "access_denied"} for addr in addrs
+    ]
+    fake_mailcow.responses["get/mailbox/user0%40example.org"] = lambda payload: {
+        "username": "user0@example.org",
+    }
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token")
+    addrs = ["user0@example.org", "user1@example.org"]
+    assert list(mailcow.del_users_mailcow(addrs)) == ["user0@example.org"]
+    mailcow.del_user_mailcow("user1@example.org")
+    with pytest.raises(MailcowError):
+        mailcow.del_user_mailcow("user0@example.org")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_iter_json_list(chunk_size):
+    doc = json.dumps([{"username": "a@x.org", "tags": ["mailadm:t1"]}, {"username": "b"}, [], "]"])
+    chunks = [doc[i : i + chunk_size] for i in range(0, len(doc), chunk_size)]
+    assert list(iter_json_list(chunks)) == json.loads(doc)
+    assert list(iter_json_list([" [ ", " ] "])) == []
+    assert list(iter_json_list(['{"type": ', '"error"}'])) == [{"type": "error"}]
+    with pytest.raises(ValueError):
+        list(iter_json_list(['[{"username": "a"} {}]']))
+    with pytest.raises(ValueError):
+        list(iter_json_list(['[{"username": ', '"a"']))
+
+
+def test_iter_users(fake_mailcow):
+    mailboxes = [
+        {"username": "tmp.%d@x.org" % (i,), "last_imap_login": i, "tags": ["mailadm:t1"]}
+        for i in range(1000)
+    ]
+    mailboxes.append({"username": "admin@x.org", "last_imap_login": 0, "tags": []})
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: mailboxes
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token")
+    users = list(mailcow.iter_users())
+    assert [user.addr for user in users] == [mailbox["username"] for mailbox in mailboxes]
+    assert (users[5].last_login, users[5].token) == (5, "t1")
+    assert users[-1].token is None
+
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: {}
+    assert mailcow.get_user_list() == []
+    fake_mailcow.responses["get/mailbox/all"] = lambda payload: {"type": "error", "msg": "x"}
+    with pytest.raises(MailcowError):
+        mailcow.get_user_list()
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(window=4, min_requests=4, reset_timeout=0.1)
+    breaker.allow()
+    breaker.record(True)
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(False)
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.allow()
+    assert excinfo.value.retry_after == 1
+
+    time.sleep(0.15)
+    breaker.allow()  # the trial request
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record(True, latency=0.01)
+    breaker.allow()
+    stats = breaker.get_stats()
+    assert (stats["opened"], stats["rejected"], stats["open"]) == (1, 2, False)
+
+
+def test_circuit_breaker_timeout():
+    breaker = CircuitBreaker(max_timeout=5)
+    assert breaker.get_timeout() == 5
+    for _ in range(10):
+        breaker.record(True, latency=0.01)
+    assert breaker.get_timeout() == CircuitBreaker.TIMEOUT_MIN
+    for _ in range(10):
+        breaker.record(True, latency=10)
+    assert breaker.get_timeout() == 5
+
+
+def test_mailcow_retries(fake_mailcow, monkeypatch):
+    monkeypatch.setattr(MailcowConnection, "RETRY_BACKOFF", 0.01)
+    fake_mailcow.responses["get/mailbox/a%40x.org"] = lambda payload: (503, {})
+    fake_mailcow.responses["add/mailbox"] = lambda payload: (503, {})
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token", breaker=CircuitBreaker())
+    with pytest.raises(MailcowError):
+        mailcow.get_user("a@x.org")
+    assert len(fake_mailcow.requests) == MailcowConnection.RETRY_ATTEMPTS
+    # adding a mailbox twice isn't safe
+    with pytest.raises(MailcowError):
+        mailcow.add_user_mailcow("a@x.org", "password", "token")
+    assert len(fake_mailcow.requests) == MailcowConnection.RETRY_ATTEMPTS + 1
+
+
+def test_mailcow_timeouts(fake_mailcow):
+    timeouts = []
+
+    class Session(requests.Session):
+        def request(self, method, url, timeout=None, **kwargs):
+            timeouts.append((method, timeout))
+            return super().request(method, url, timeout=timeout, **kwargs)
+
+    fake_mailcow.responses["get/mailbox/a%40x.org"] = lambda payload: {}
+    fake_mailcow.responses["add/mailbox"] = lambda payload: [{"type": "success"}]
+    breaker = CircuitBreaker()
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token", session=Session(), breaker=breaker)
+    for _ in range(5):
+        mailcow.get_user("a@x.org")
+    assert breaker.get_timeout() < HTTP_TIMEOUT
+    mailcow.add_user_mailcow("a@x.org", "password", "token")
+    # creating a mailbox may be slow, and a timeout could leave it behind half done
+    assert timeouts[-1] == ("POST", HTTP_TIMEOUT)
+    assert timeouts[-2][1] < HTTP_TIMEOUT
+
+
+def test_mailcow_unreachable_fails_fast(monkeypatch):
+    monkeypatch.setattr(MailcowConnection, "RETRY_BACKOFF", 0.01)
+    breaker = CircuitBreaker(min_requests=3)
+    mailcow = MailcowConnection("http://127.0.0.1:1/api/v1/", "token", breaker=breaker)
+    with pytest.raises(requests.ConnectionError):
+        mailcow.get_user("a@x.org")
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        mailcow.add_user_mailcow("a@x.org", "password", "token")
+
+
+def test_circuit_breaker_trial_raises(fake_mailcow):
+    class Session(requests.Session):
+        broken = True
+
+        def request(self, method, url, **kwargs):
+            if self.broken:
+                raise requests.exceptions.ChunkedEncodingError("connection broken")
+            return super().request(method, url, **kwargs)
+
+    fake_mailcow.responses["get/mailbox/a%40x.org"] = lambda payload: {}
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=0.1)
+    session = Session()
+    mailcow = MailcowConnection(fake_mailcow.endpoint, "token", session=session, breaker=breaker)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        mailcow.get_user("a@x.org")
+    assert breaker.is_open()
+    time.sleep(0.1)
+    # the trial request fails with something else than a connection error
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        mailcow.get_user("a@x.org")
+    assert breaker.is_open()
+    session.broken = False
+    time.sleep(0.1)
+    assert mailcow.get_user("a@x.org") is None
+    assert not breaker.is_open()
@@ -0,0 +1,61 @@
+import logging
+import os
+
+from mailadm.profiling import QueryProfiler, format_top_queries
+
+
+def test_record_histogram():
+    profiler = QueryProfiler()
+    profiler.record("get_user_by_addr", "SELECT 1", 0.0005, 1)
+    profiler.record("get_user_by_addr", "SELECT 1", 0.05, 1)
+    profiler.record("get_expired_users", "SELECT 2", 2.0, 1000)
+    entries = {entry["label"]: entry for entry in profiler.get_entries()}
+    assert entries["get_user_by_addr"]["calls"] == 2
+    assert entries["get_user_by_addr"]["rows"] == 2
+    assert entries["get_user_by_addr"]["histogram"] == [1, 0, 1, 0, 0]
+    assert entries["get_expired_users"]["histogram"] == [0, 0, 0, 0, 1]
+
+    out = format_top_queries(profiler.get_entries(), limit=1)
+    assert out.startswith("get_expired_users: 1 calls")
+    assert "get_user_by_addr" not in out
+
+
+def test_slow_query_log(caplog):
+    profiler = QueryProfiler(slow_query_threshold=0.1)
+    with caplog.at_level(logging.WARNING):
+        profiler.record("fast", "SELECT 1", 0.01)
+        profiler.record("slow", "SELECT 2", 0.2)
+    assert "slow query in slow" in caplog.text
+    assert "fast" not in caplog.text
+
+
+def test_merge_processes(tmpdir):
+    other = QueryProfiler(stats_dir=tmpdir.join("stats").strpath)
+    other.record("get_user_list", "SELECT 1", 0.5, 10)
+    other._pid += 1  # pretend the other profiler is in a different process
+    other.write(other.get_entries())
+
+    profiler = QueryProfiler(stats_dir=tmpdir.join("stats").strpath)
+    profiler.record("get_user_list", "SELECT 1", 0.25, 5)
+    [entry] = profiler.get_all_entries()
+    assert entry["calls"] == 2
+    assert entry["rows"] == 15
+    assert entry["max"] == 0.5
+
+    profiler.reset()
+    assert profiler.get_all_entries() == []
+
+
+def test_process_stats(tmpdir):
+    stats_dir = tmpdir.join("stats").strpath
+    other = QueryProfiler(stats_dir=stats_dir, process_stats=lambda: {"waits": 3})
+    other._pid += 1  # pretend the other profiler is in a different process
+    other.write(other.get_entries())
+
+    profiler = QueryProfiler(stats_dir=stats_dir, process_stats=lambda: {"waits": 1})
+    assert profiler.get_all_process_stats() == {
+        os.getpid() + 1: {"waits": 3},
+        os.getpid(): {"waits": 1},
+    }
+    profiler.reset()
+    assert profiler.get_all_process_stats() == {os.getpid(): {"waits": 1}}
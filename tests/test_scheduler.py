@@ -0,0 +1,60 @@
+import time
+
+import mailadm.scheduler
+from mailadm.mailcow import CircuitOpenError
+from mailadm.scheduler import PruneScheduler
+
+
+def test_prune_when_next_account_expires(tmpdir, make_fake_db, fake_mailcow):
+    fake_mailcow.responses["delete/mailbox"] = lambda addrs: [
+        {"type": "success", "msg": ["mailbox_removed", addr]} for addr in addrs
+    ]
+    db = make_fake_db(tmpdir)
+    now = int(time.time())
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.add_user_db("xyz.1@example.org", date=now - 4000, ttl=3600, token_name="pytest:1h")
+        conn.add_user_db("xyz.2@example.org", date=now, ttl=3600, token_name="pytest:1h")
+
+    scheduler = PruneScheduler(db, poll_interval=60)
+    assert scheduler.is_due(now)
+    scheduler.prune()
+    assert [path for _, path, _ in fake_mailcow.requests] == ["delete/mailbox"]
+    assert scheduler.get_next_prune(now) == now + 3600
+    assert not scheduler.is_due(now)
+
+    # an account which expires earlier is only noticed when polling or triggered
+    with db.write_transaction() as conn:
+        conn.add_user_db("xyz.3@example.org", date=now, ttl=60, token_name="pytest:1h")
+    assert scheduler.get_next_prune(now + 1) == now + 3600
+    scheduler.trigger()
+    assert scheduler.get_next_prune(now + 1) == now + 60
+    assert scheduler.get_next_prune(now + 120) == now + 60
+    assert scheduler.is_due(now + 120)
+
+
+def test_retry_failed_prune(tmpdir, make_fake_db, fake_mailcow):
+    db = make_fake_db(tmpdir)
+    now = int(time.time())
+    with db.write_transaction() as conn:
+        conn.add_token(name="pytest:1h", prefix="xyz", expiry="1h", token="1234567890")
+        conn.add_user_db("xyz.1@example.org", date=now - 4000, ttl=3600, token_name="pytest:1h")
+
+    scheduler = PruneScheduler(db, recheck_interval=3600, retry_interval=600)
+    assert scheduler.prune()["status"] == "error"
+    next_prune = scheduler.get_next_prune(now)
+    assert now + 600 <= next_prune <= now + 601
+
+
+def test_retry_prune_after_exception(tmpdir, make_fake_db, monkeypatch):
+    db = make_fake_db(tmpdir)
+    now = int(time.time())
+
+    def prune(db, max_seconds=None):
+        raise CircuitOpenError(retry_after=30)
+
+    monkeypatch.setattr(mailadm.scheduler, "prune", prune)
+    scheduler = PruneScheduler(db, recheck_interval=3600, retry_interval=600)
+    assert scheduler.prune()["status"] == "error"
+    next_prune = scheduler.get_next_prune(now)
+    assert now + 600 <= next_prune <= now + 601
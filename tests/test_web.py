@@ -2,6 +2,7 @@ import random
 import time
 
 import mailadm
+from mailadm.mailcow import MailcowConnection, MailcowError
 from mailadm.web import create_app_from_db_path
 
 
@@ -110,3 +111,53 @@ def xxxtest_new_user_usermod(db, mailcow_domain):
     assert r.json["email"] == "hello2@" + mailcow_domain
     assert r.json["password"] == "l123123123123"
     assert int(r.json["expires"]) > (now + 4 * 24 * 60 * 60)
+
+
+def test_new_user_no_lock_during_mailcow(db, monkeypatch):
+    """Test that the database isn't locked while mailcow creates the account"""
+    with db.write_transaction() as conn:
+        token = conn.add_token("pytest:web", expiry="1w", token="1w_7wDioPeeXyZx96v", prefix="")
+    app = create_app_from_db_path(db.path)
+    app.debug = True
+    app = app.test_client()
+
+    def add_user_mailcow(self, addr, password, token, quota=0):
+        # this would time out if the account creation held the write lock:
+        with app.application.db.write_transaction() as conn:
+            conn.get_user_by_addr(addr)
+        if addr.startswith("fail"):
+            raise MailcowError("mailcow is broken")
+
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: None)
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+
+    r = app.post("/?t=" + token.token)
+    assert r.status_code == 200
+    with db.read_connection() as conn:
+        assert conn.get_user_by_addr(r.json["email"])
+        assert conn.get_tokeninfo_by_name("pytest:web").usecount == 1
+
+    monkeypatch.setattr(mailadm.util, "get_human_readable_id", lambda *args, **kwargs: "x")
+    with db.write_transaction() as conn:
+        token = conn.add_token("pytest:fail", expiry="1w", token="1w_7wDioPeeX", prefix="fail")
+    r = app.post("/?t=" + token.token)
+    assert r.status_code == 500
+    with db.read_connection() as conn:
+        assert conn.execute("SELECT count(*) FROM users").fetchone()[0] == 1
+        assert conn.get_tokeninfo_by_name("pytest:fail").usecount == 0
+
+
+def test_mailcow_unavailable(db, monkeypatch):
+    with db.write_transaction() as conn:
+        token = conn.add_token("pytest:web", expiry="1w", token="1w_7wDioPeeXyZx96v", prefix="")
+    breaker = mailadm.mailcow.CircuitBreaker(min_requests=1, reset_timeout=60)
+    breaker.record(False)
+    monkeypatch.setattr(mailadm.mailcow, "circuit_breaker", breaker)
+    app = create_app_from_db_path(db.path).test_client()
+
+    r = app.post("/?t=" + token.token)
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "60"
+    with db.read_connection() as conn:
+        assert conn.execute("SELECT count(*) FROM users").fetchone()[0] == 0
+        assert conn.get_tokeninfo_by_name("pytest:web").usecount == 0
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from mailadm.workers import WorkerPool
+
+
+def test_tasks_of_one_key_run_in_order():
+    pool = WorkerPool(workers=4)
+    done = []
+    for i in range(20):
+        pool.submit("admin", lambda i=i: done.append(i))
+    pool.shutdown()
+    assert done == list(range(20))
+
+
+def test_keys_run_concurrently():
+    pool = WorkerPool(workers=2)
+    slow_started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        slow_started.set()
+        release.wait(5)
+
+    fast_done = threading.Event()
+    pool.submit("admin1", slow)
+    assert slow_started.wait(5)
+    pool.submit("admin1", fast_done.set)
+    pool.submit("admin2", lambda: None)
+    pool.submit("admin2", fast_done.set)
+    # the second task of admin1 waits for the slow one, admin2 doesn't
+    assert fast_done.wait(5)
+    assert pool.get_pending() == 1
+    release.set()
+    pool.shutdown()
+    assert pool.get_pending() == 0
+
+
+def test_max_pending_and_timeout(caplog):
+    pool = WorkerPool(workers=1, max_pending=2, timeout=0.1)
+    release = threading.Event()
+    started = threading.Event()
+    done = []
+    dropped = []
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    assert pool.submit("admin", block)
+    assert started.wait(5)
+    assert pool.submit("admin", lambda: done.append(1), on_timeout=lambda: dropped.append(1))
+    assert pool.submit("admin", lambda: done.append(2))
+    assert not pool.submit("admin", lambda: done.append(3))
+    time.sleep(0.2)
+    release.set()
+    pool.shutdown()
+    assert done == []
+    assert dropped == [1]
+    assert caplog.text.count("dropping a task of 'admin'") == 2